@@ -1,2 +1,15 @@
+from . import archive
+from . import bulk
+from . import database
+from . import columns
+from . import convert
 from . import download
-from . import read
\ No newline at end of file
+from . import export
+from . import fingerprint
+from . import localtime
+from . import pipeline
+from . import profiling
+from . import read
+from . import release
+from . import serve
+from . import validate
@@ -0,0 +1,217 @@
+"""
+Open Power System Data
+
+Timeseries Datapackage
+
+archive.py : compressed, content-addressed store of downloaded files
+
+"""
+
+import gzip
+import hashlib
+import json
+import logging
+import os
+import shutil
+
+logger = logging.getLogger('log')
+logger.setLevel('INFO')
+
+INDEX_FILE = 'index.json'
+OBJECTS_DIR = 'objects'
+
+
+class ArchiveFile(gzip.GzipFile):
+    """
+    Read-only file-like handle on an archived file, decompressed on the fly.
+    ``name`` is the original filename, ``size`` its uncompressed size and
+    ``container`` the period it was downloaded for.
+
+    """
+
+    def __init__(self, object_path, filename, size, container=None):
+        raw = open(object_path, 'rb')
+        super(ArchiveFile, self).__init__(
+            filename=filename, mode='rb', fileobj=raw)
+        # Let GzipFile.close() close the underlying file, too.
+        self.myfileobj = raw
+        self.size = size
+        self.container = container
+
+
+class Archive(object):
+    """
+    Store of raw downloads, compressed with gzip and addressed by the
+    sha256 of their content, so that identical downloads are kept once.
+    A single index file maps each (source, variable, container) to its
+    content, replacing the one-directory-per-period layout of
+    ``original_data``.
+
+    Parameters
+    ----------
+    path : str
+        Directory of the archive. Created if it does not exist.
+
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._index_path = os.path.join(path, INDEX_FILE)
+        os.makedirs(os.path.join(path, OBJECTS_DIR), exist_ok=True)
+        if os.path.exists(self._index_path):
+            with open(self._index_path, 'r') as f:
+                self.index = json.load(f)
+        else:
+            self.index = {}
+
+    @staticmethod
+    def _key(source_name, variable_name, container):
+        return '/'.join([source_name, variable_name, container])
+
+    def _object_path(self, checksum):
+        return os.path.join(self.path, OBJECTS_DIR, checksum[:2],
+                            checksum + '.gz')
+
+    def save_index(self):
+        """Write the index to disk, replacing the old one atomically."""
+        tmp_path = self._index_path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(self.index, f, indent=1, sort_keys=True)
+        os.replace(tmp_path, self._index_path)
+
+    def add(self, source_name, variable_name, container, filepath,
+            save=True):
+        """
+        Add the file at filepath under the given container. The content is
+        only compressed and stored if it is not in the archive yet.
+        Returns the sha256 of the content.
+
+        Parameters
+        ----------
+        source_name : str
+            Name of source dataset, e.g. ``TenneT``
+        variable_name : str
+            Name of variable, e.g. ``solar``
+        container : str
+            Name of the period, e.g. ``2015-01-01_2015-01-31``
+        filepath : str
+            Path of the downloaded file.
+        save : bool
+            If False, the index is only written by ``save_index``.
+
+        """
+        checksum = hashlib.sha256()
+        with open(filepath, 'rb') as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b''):
+                checksum.update(chunk)
+        checksum = checksum.hexdigest()
+
+        object_path = self._object_path(checksum)
+        if not os.path.exists(object_path):
+            os.makedirs(os.path.dirname(object_path), exist_ok=True)
+            tmp_path = object_path + '.tmp'
+            with open(filepath, 'rb') as f_in, \
+                    gzip.open(tmp_path, 'wb') as f_out:
+                shutil.copyfileobj(f_in, f_out, 1024 * 1024)
+            os.replace(tmp_path, object_path)
+
+        self.index[self._key(source_name, variable_name, container)] = {
+            'sha256': checksum,
+            'filename': os.path.basename(filepath),
+            'size': os.path.getsize(filepath),
+        }
+        if save:
+            self.save_index()
+        return checksum
+
+    def containers(self, source_name, variable_name):
+        """
+        List the containers archived for a variable of a source.
+        Returns a sorted list of container names.
+
+        """
+        prefix = self._key(source_name, variable_name, '')
+        return sorted(key[len(prefix):] for key in self.index
+                      if key.startswith(prefix))
+
+    def has(self, source_name, variable_name, container):
+        """Return whether a file is archived under the given container."""
+        return self._key(source_name, variable_name, container) in self.index
+
+    def entry(self, source_name, variable_name, container):
+        """Return the index entry (sha256, filename, size) of a file."""
+        return self.index[self._key(source_name, variable_name, container)]
+
+    def open(self, source_name, variable_name, container):
+        """
+        Open an archived file for reading without unpacking it to disk.
+        Returns an ArchiveFile, which the read functions accept in place of
+        a filepath.
+
+        """
+        entry = self.entry(source_name, variable_name, container)
+        return ArchiveFile(self._object_path(entry['sha256']),
+                           entry['filename'], entry['size'], container)
+
+    def stats(self):
+        """
+        Summarize the archive. Returns a dict with the number of entries and
+        distinct files, and their raw and compressed sizes in bytes.
+
+        """
+        distinct = {e['sha256']: e['size'] for e in self.index.values()}
+        return {
+            'entries': len(self.index),
+            'files': len(distinct),
+            'raw_bytes': sum(e['size'] for e in self.index.values()),
+            'stored_bytes': sum(
+                os.path.getsize(self._object_path(c)) for c in distinct),
+        }
+
+
+def archive_tree(out_path, archive_path, remove=False):
+    """
+    Add all files downloaded to out_path by ``download`` to the archive at
+    archive_path. Returns the Archive.
+
+    Parameters
+    ----------
+    out_path : str
+        Base download directory in which all files were saved.
+    archive_path : str
+        Directory of the archive.
+    remove : bool
+        If True, delete each container from out_path once it is archived.
+        Pass the archive to ``download`` afterwards, so that the removed
+        files are not downloaded again.
+
+    """
+    archive = Archive(archive_path)
+    archived = []
+    for source_name in sorted(os.listdir(out_path)):
+        source_dir = os.path.join(out_path, source_name)
+        # Skip unfinished downloads and plain files.
+        if source_name.startswith('.') or not os.path.isdir(source_dir):
+            continue
+        for variable_name in sorted(os.listdir(source_dir)):
+            variable_dir = os.path.join(source_dir, variable_name)
+            for container in sorted(os.listdir(variable_dir)):
+                container_dir = os.path.join(variable_dir, container)
+                files = os.listdir(container_dir)
+                if not len(files) == 1:
+                    logger.info('error: found more than one file in %s %s %s',
+                                source_name, variable_name, container)
+                    continue
+                archive.add(source_name, variable_name, container,
+                            os.path.join(container_dir, files[0]),
+                            save=False)
+                archived.append(container_dir)
+    archive.save_index()
+
+    # Only delete the originals once the index pointing to them is saved.
+    if remove:
+        for container_dir in archived:
+            shutil.rmtree(container_dir)
+
+    logger.info('archive %s: %s', archive_path, archive.stats())
+    return archive
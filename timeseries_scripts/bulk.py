@@ -0,0 +1,425 @@
+"""
+Open Power System Data
+
+Timeseries Datapackage
+
+bulk.py : memory-mapped bulk decoding of large delimited source files
+
+"""
+
+import logging
+import mmap
+
+import numpy as np
+import pandas as pd
+
+from .localtime import NS_PER_MINUTE, utc_offsets
+
+logger = logging.getLogger('log')
+logger.setLevel('INFO')
+
+# Bytes that may surround or pad a numeric field without changing its value.
+_PADDING = b' \t\r"'
+
+# Width of the fields addressed by each directive in a fixed-width date format.
+_DIRECTIVES = {'d': 2, 'm': 2, 'Y': 4, 'H': 2, 'M': 2, 'S': 2}
+
+_DAYS_IN_MONTH = np.array([31, 28, 31, 30, 31, 30, 31, 31, 30, 31, 30, 31])
+
+# Longer than any jump of a UTC offset, so the offsets before and after a
+# transition are both found around each local time.
+_TRANSITION_WINDOW = 3 * 60 * NS_PER_MINUTE
+
+
+def _line_bounds(data, skiprows):
+    """
+    Locate the first and one-past-last byte of every non-empty line after
+    the first ``skiprows`` lines. Returns a tuple of two int64 arrays.
+
+    """
+    ends = np.flatnonzero(data == ord('\n'))
+    if len(data) and (len(ends) == 0 or ends[-1] != len(data) - 1):
+        ends = np.append(ends, len(data))
+    starts = np.concatenate([[0], ends[:-1] + 1]).astype(np.int64)
+    starts, ends = starts[skiprows:], ends[skiprows:]
+
+    # Strip a trailing carriage return from lines ending in '\r\n'.
+    last = np.clip(ends - 1, 0, max(len(data) - 1, 0))
+    has_cr = (ends > starts) & (data[last] == ord('\r'))
+    ends = ends - has_cr
+
+    keep = ends > starts
+    return starts[keep], ends[keep]
+
+
+def _field_bounds(data, starts, ends, sep):
+    """
+    Split each line at ``sep``. Returns two arrays of shape (lines, fields)
+    holding the first and one-past-last byte of each field.
+
+    Raises ValueError if the lines do not all have the same number of fields.
+
+    """
+    seps = np.flatnonzero(data == ord(sep))
+    # Map each separator onto the line it belongs to, dropping those in
+    # skipped or empty lines.
+    line = np.searchsorted(ends, seps)
+    inside = line < len(ends)
+    inside[inside] = seps[inside] >= starts[line[inside]]
+    seps, line = seps[inside], line[inside]
+
+    counts = np.bincount(line, minlength=len(starts))
+    if len(counts) and (counts != counts[0]).any():
+        bad = np.flatnonzero(counts != counts[0])[0]
+        raise ValueError(
+            'inconsistent number of fields in line starting at byte {}'
+            .format(starts[bad])
+        )
+    n_seps = counts[0] if len(counts) else 0
+    seps = seps.reshape(len(starts), n_seps)
+
+    field_starts = np.column_stack([starts, seps + 1])
+    field_ends = np.column_stack([seps, ends])
+    return field_starts, field_ends
+
+
+def _char_matrix(data, fstart, fend):
+    """
+    Gather the bytes of one field per line into a padded (lines, width)
+    uint8 matrix. Returns the matrix and the per-line validity mask.
+
+    """
+    width = fend - fstart
+    max_width = int(width.max()) if len(width) else 0
+    offsets = np.arange(max_width)
+    valid = offsets < width[:, None]
+    idx = np.minimum(fstart[:, None] + offsets, len(data) - 1)
+    chars = np.where(valid, data[idx], ord(' ')).astype(np.uint8)
+    return chars, valid
+
+
+def decode_numeric(data, fstart, fend, decimal='.', thousands=None):
+    """
+    Decode one numeric field per line straight from the raw bytes into a
+    float64 array. Empty fields become NaN. Returns a numpy.ndarray.
+
+    Raises ValueError on any byte that is not part of a plain decimal number,
+    so callers can fall back to a full parser.
+
+    Parameters
+    ----------
+    data : numpy.ndarray
+        uint8 view of the whole file.
+    fstart : numpy.ndarray
+        Offset of the first byte of the field in each line.
+    fend : numpy.ndarray
+        Offset one past the last byte of the field in each line.
+    decimal : str
+        Character marking the decimal point.
+    thousands : str, optional
+        Character used as thousands separator, which is ignored.
+
+    """
+    chars, valid = _char_matrix(data, fstart, fend)
+
+    is_digit = (chars >= ord('0')) & (chars <= ord('9'))
+    is_decimal = chars == ord(decimal)
+    is_minus = chars == ord('-')
+    is_sign = is_minus | (chars == ord('+'))
+    is_padding = np.zeros(chars.shape, dtype=bool)
+    for c in _PADDING:
+        is_padding |= chars == c
+    allowed = is_digit | is_decimal | is_sign | is_padding
+    if thousands:
+        allowed |= chars == ord(thousands)
+    if not allowed.all():
+        row = np.flatnonzero(~allowed.all(axis=1))[0]
+        raise ValueError(
+            'unexpected character in numeric field {!r}'
+            .format(bytes(data[fstart[row]:fend[row]]))
+        )
+    if (is_decimal.sum(axis=1) > 1).any():
+        raise ValueError('more than one decimal mark in a numeric field')
+
+    # A sign may only lead the number, and padding only surround it, as
+    # pd.read_csv would otherwise keep the field as text, e.g. ``1-2``.
+    positions = np.arange(chars.shape[1])
+    content = ~is_padding & valid
+    first = np.where(content.any(axis=1), content.argmax(axis=1), 0)
+    last = chars.shape[1] - 1 - content[:, ::-1].argmax(axis=1)
+    inner = (positions > first[:, None]) & (positions <= last[:, None]) \
+        & content.any(axis=1)[:, None]
+    if (is_sign & inner).any() or (is_padding & inner & valid).any():
+        raise ValueError('sign or padding inside a numeric field')
+
+    n_digits = is_digit.sum(axis=1)
+    if ((n_digits == 0) & content.any(axis=1)).any():
+        raise ValueError('numeric field without digits')
+    if (n_digits > 15).any():
+        raise ValueError('too many digits for exact decoding')
+
+    # Accumulate all digits into an integer mantissa and count those after
+    # the decimal mark, so every value is rounded exactly once.
+    has_decimal = is_decimal.any(axis=1)
+    decimal_pos = np.where(has_decimal, is_decimal.argmax(axis=1), chars.shape[1])
+    n_frac = (is_digit & (np.arange(chars.shape[1]) > decimal_pos[:, None])).sum(axis=1)
+
+    mantissa = np.zeros(len(chars), dtype=np.int64)
+    for j in range(chars.shape[1]):
+        column = is_digit[:, j]
+        mantissa[column] = mantissa[column] * 10 + (chars[column, j] - ord('0'))
+
+    values = mantissa / np.power(10.0, n_frac)
+    values[is_minus.any(axis=1)] *= -1
+    values[n_digits == 0] = np.nan
+    return values
+
+
+def decode_datetime(data, fstart, fend, date_format):
+    """
+    Decode one fixed-width date or time field per line, e.g. ``%d.%m.%Y`` or
+    ``%H:%M``, into integer components. Returns a dict mapping the format
+    directives found (``Y``, ``m``, ``d``, ``H``, ``M``, ``S``) to int64 arrays.
+
+    Raises ValueError if a field does not match the format.
+
+    """
+    # Skip over leading quotes and blanks, which some sources add.
+    chars, valid = _char_matrix(data, fstart, fend)
+    lead = np.zeros(len(chars), dtype=np.int64)
+    padded = np.ones(len(chars), dtype=bool)
+    for j in range(chars.shape[1]):
+        padded &= (chars[:, j] == ord('"')) | (chars[:, j] == ord(' '))
+        lead += padded
+    fstart = fstart + lead
+
+    parts = {}
+    pos = 0
+    i = 0
+    while i < len(date_format):
+        if date_format[i] == '%':
+            directive = date_format[i + 1]
+            width = _DIRECTIVES[directive]
+            value = np.zeros(len(fstart), dtype=np.int64)
+            for k in range(width):
+                idx = fstart + pos + k
+                if (idx >= fend).any():
+                    raise ValueError('field shorter than {}'.format(date_format))
+                digit = data[idx].astype(np.int64) - ord('0')
+                if ((digit < 0) | (digit > 9)).any():
+                    raise ValueError('non-digit where {} expects %{}'
+                                     .format(date_format, directive))
+                value = value * 10 + digit
+            parts[directive] = value
+            pos += width
+            i += 2
+        else:
+            if (data[np.minimum(fstart + pos, len(data) - 1)] !=
+                    ord(date_format[i])).any():
+                raise ValueError('field does not match {}'.format(date_format))
+            pos += 1
+            i += 1
+    return parts
+
+
+def build_index(parts):
+    """
+    Assemble naive timestamps from the integer components returned by
+    ``decode_datetime``. Returns a pandas.DatetimeIndex.
+
+    """
+    year, month, day = parts['Y'], parts['m'], parts['d']
+    hour = parts.get('H', 0)
+    minute = parts.get('M', 0)
+    second = parts.get('S', 0)
+    if (((month < 1) | (month > 12) | (day < 1)).any() or
+            (np.asarray(hour) > 23).any() or (np.asarray(minute) > 59).any()):
+        raise ValueError('date component out of range')
+    leap = (year % 4 == 0) & ((year % 100 != 0) | (year % 400 == 0))
+    if (day > _DAYS_IN_MONTH[month - 1] + (leap & (month == 2))).any():
+        raise ValueError('day out of range for month')
+
+    stamps = (
+        (year - 1970).astype('datetime64[Y]').astype('datetime64[M]')
+        + (month - 1).astype('timedelta64[M]')
+    ).astype('datetime64[D]') + (day - 1).astype('timedelta64[D]')
+    seconds = (np.asarray(hour) * 3600 + np.asarray(minute) * 60
+               + np.asarray(second)).astype('timedelta64[s]')
+    stamps = stamps.astype('datetime64[ns]') + seconds
+    return pd.DatetimeIndex(stamps, name='timestamp')
+
+
+def localize(index, zone, ambiguous='raise'):
+    """
+    Convert naive local wall-clock times of zone to naive UTC, looking up
+    the UTC offsets in the transition table of the zone instead of
+    localizing the index with pandas. Returns a pandas.DatetimeIndex.
+
+    Raises ValueError for local times skipped when clocks are put forward,
+    and for repeated ones that ambiguous does not resolve.
+
+    Parameters
+    ----------
+    index : pandas.DatetimeIndex
+        Naive local times.
+    zone : str
+        Name of the time zone, e.g. ``Europe/Berlin``.
+    ambiguous : str, bool or numpy.ndarray
+        How to place the hour that is repeated when clocks are put back, as
+        in ``tz_localize``: ``infer`` from the order of the data, True for
+        summer time, False for winter time, a boolean array with one entry
+        per row, or ``raise``.
+
+    """
+    local = index.values.astype('datetime64[ns]').astype(np.int64)
+    before = utc_offsets(local - _TRANSITION_WINDOW, zone) \
+        .astype(np.int64) * NS_PER_MINUTE
+    after = utc_offsets(local + _TRANSITION_WINDOW, zone) \
+        .astype(np.int64) * NS_PER_MINUTE
+    # An offset fits a local time if the UTC time it gives has that offset.
+    fits_before = utc_offsets(local - before, zone) \
+        .astype(np.int64) * NS_PER_MINUTE == before
+    fits_after = utc_offsets(local - after, zone) \
+        .astype(np.int64) * NS_PER_MINUTE == after
+    if not (fits_before | fits_after).all():
+        raise ValueError('local time does not exist in {}'.format(zone))
+
+    utc = np.where(fits_after, local - after, local - before)
+    repeated = np.flatnonzero(fits_before & fits_after & (before != after))
+    if len(repeated):
+        if isinstance(ambiguous, str) and ambiguous == 'infer':
+            # Each repeated time has to appear twice, first in summer time.
+            walls, first, counts = np.unique(
+                local[repeated], return_index=True, return_counts=True)
+            if (counts != 2).any():
+                raise ValueError('cannot infer summer time from the order')
+            summer = np.zeros(len(repeated), dtype=bool)
+            summer[first] = True
+        elif isinstance(ambiguous, str):
+            raise ValueError('ambiguous local time in {}'.format(zone))
+        else:
+            summer = np.broadcast_to(
+                np.asarray(ambiguous, dtype=bool), local.shape)[repeated]
+        utc[repeated] = local[repeated] - np.where(
+            summer,
+            np.maximum(before, after)[repeated],
+            np.minimum(before, after)[repeated])
+    return pd.DatetimeIndex(utc.astype('datetime64[ns]'), name=index.name)
+
+
+def read_csv_bulk(filepath, sep, skiprows, date_col, date_format,
+                  value_cols, time_col=None, time_format=None,
+                  decimal='.', thousands=None, tz=None, ambiguous='raise'):
+    """
+    Read a delimited file with one timestamp and several numeric columns by
+    memory-mapping it and decoding the needed fields into preallocated
+    arrays, without building Python objects per cell.
+    Returns a pandas.DataFrame with a naive DatetimeIndex, in UTC if tz is
+    given and in the local time of the file otherwise.
+
+    Raises ValueError if the file does not follow the expected layout, in
+    which case callers should fall back to ``pd.read_csv``.
+
+    Parameters
+    ----------
+    filepath : str or file-like
+        Directory path of file to be read, or an open binary file.
+    sep : str
+        Single-character field delimiter.
+    skiprows : int
+        Number of lines before the first data line.
+    date_col : int
+        Position of the field holding the date.
+    date_format : str
+        Fixed-width format of the date field, e.g. ``%d.%m.%Y``.
+    value_cols : list of tuple
+        (column name, field position) for each numeric column to be read.
+    time_col : int, optional
+        Position of the field holding the time of day, if separate.
+    time_format : str, optional
+        Fixed-width format of the time field, e.g. ``%H:%M``.
+    decimal : str
+        Character marking the decimal point.
+    thousands : str, optional
+        Character used as thousands separator.
+    tz : str, optional
+        Time zone of the timestamps in the file, e.g. ``Europe/Berlin``.
+    ambiguous : str, bool, numpy.ndarray or function
+        How to place the repeated hour at the end of summer time, see
+        ``localize``. A function is called with the local DatetimeIndex and
+        returns one of these.
+
+    """
+    # File-like objects, e.g. from archive.py, are read into memory once.
+    if hasattr(filepath, 'read'):
+        position = filepath.tell()
+        try:
+            data = np.frombuffer(filepath.read(), dtype=np.uint8)
+        finally:
+            filepath.seek(position)
+        if len(data) == 0:
+            raise ValueError('empty file')
+        return _decode(data, getattr(filepath, 'name', ''), sep, skiprows,
+                       date_col, date_format, value_cols, time_col,
+                       time_format, decimal, thousands, tz, ambiguous)
+
+    with open(filepath, 'rb') as f:
+        try:
+            mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            raise ValueError('cannot map empty file {}'.format(filepath))
+
+    # The mapping can only be closed once no array views on it are left,
+    # so errors are caught here and re-raised after the traceback is gone.
+    error = None
+    try:
+        data = np.frombuffer(mm, dtype=np.uint8)
+        try:
+            df = _decode(data, filepath, sep, skiprows, date_col, date_format,
+                         value_cols, time_col, time_format, decimal, thousands,
+                         tz, ambiguous)
+        except ValueError as e:
+            error = str(e)
+        del data
+    finally:
+        mm.close()
+    if error is not None:
+        raise ValueError(error)
+
+    return df
+
+
+def _decode(data, filepath, sep, skiprows, date_col, date_format,
+            value_cols, time_col, time_format, decimal, thousands,
+            tz=None, ambiguous='raise'):
+    """Body of ``read_csv_bulk`` operating on the mapped bytes."""
+    starts, ends = _line_bounds(data, skiprows)
+    if len(starts) == 0:
+        raise ValueError('no data lines in {}'.format(filepath))
+    fstarts, fends = _field_bounds(data, starts, ends, sep)
+
+    needed = [date_col] + [pos for name, pos in value_cols]
+    if time_col is not None:
+        needed.append(time_col)
+    if max(needed) >= fstarts.shape[1]:
+        raise ValueError('{} has only {} fields per line'
+                         .format(filepath, fstarts.shape[1]))
+
+    parts = decode_datetime(
+        data, fstarts[:, date_col], fends[:, date_col], date_format)
+    if time_col is not None:
+        parts.update(decode_datetime(
+            data, fstarts[:, time_col], fends[:, time_col], time_format))
+    index = build_index(parts)
+    if tz is not None:
+        if callable(ambiguous):
+            ambiguous = ambiguous(index)
+        index = localize(index, tz, ambiguous)
+
+    columns = {}
+    for name, pos in value_cols:
+        columns[name] = decode_numeric(
+            data, fstarts[:, pos], fends[:, pos], decimal, thousands)
+
+    return pd.DataFrame(columns, index=index,
+                        columns=[name for name, pos in value_cols])
@@ -0,0 +1,222 @@
+"""
+Open Power System Data
+
+Timeseries Datapackage
+
+columns.py : shared catalog of output columns
+
+"""
+
+import logging
+import os
+import sys
+import threading
+
+import pandas as pd
+import yaml
+
+logger = logging.getLogger('log')
+logger.setLevel('INFO')
+
+# File the catalog is kept in, next to sources.yml.
+CATALOG_FILE = 'columns.yml'
+
+
+class ColumnCatalog(object):
+    """
+    Registry assigning a stable integer ID to every
+    (variable, region, attribute, source) combination and providing the
+    canonical, lexsorted column order shared by all readers.
+
+    IDs are kept in a YAML file, so a column keeps its ID across runs. New
+    columns get their IDs in sorted order once they are asked for or saved,
+    after all known ones, so the IDs do not depend on the order in which
+    files were read.
+
+    Parameters
+    ----------
+    path : str, optional
+        YAML file the catalog is loaded from if it exists, so that IDs stay
+        the same across runs. Written back by ``save``.
+
+    """
+
+    def __init__(self, path=None):
+        self.path = path
+        self._ids = {}
+        self._keys = {}
+        self._web = {}
+        # Readers may run in several threads, see pipeline.py.
+        self._lock = threading.Lock()
+        if path is not None and os.path.exists(path):
+            self.load(path)
+
+    def __len__(self):
+        return len(self._web)
+
+    def __contains__(self, key):
+        return tuple(key[:4]) in self._web
+
+    def open(self, path):
+        """
+        Keep the catalog in ``path`` from now on, loading the entries saved
+        there before if the file exists. Returns None.
+
+        """
+        self.path = path
+        if os.path.exists(path):
+            self.load(path)
+
+    def register(self, variable, region, attribute, source, web):
+        """
+        Add a column to the catalog, or update its URL if it changed, e.g.
+        after an edit of sources.yml. The URL is not part of the ID.
+
+        """
+        key = (variable, region, attribute, source)
+        with self._lock:
+            if self._web.get(key) != web:
+                # Interning lets all columns of a source share one URL string.
+                self._web[key] = sys.intern(web) if isinstance(web, str) else web
+
+    def assign_ids(self):
+        """
+        Give the registered columns without an ID the next free IDs, in
+        sorted order. Returns None.
+
+        """
+        with self._lock:
+            next_id = max(self._keys) + 1 if self._keys else 0
+            for key in sorted(k for k in self._web if k not in self._ids):
+                self._ids[key] = next_id
+                self._keys[next_id] = key
+                next_id += 1
+
+    def adopt(self, columns, ids):
+        """
+        Take over the IDs assigned to columns by another process, e.g. the
+        one that wrote a columnar file. Raises ValueError if a column or ID
+        is known with a different meaning.
+
+        """
+        with self._lock:
+            for col, column_id in zip(columns, ids):
+                key = tuple(col[:4])
+                if self._ids.get(key, column_id) != column_id or \
+                        self._keys.get(column_id, key) != key:
+                    raise ValueError(
+                        'column {} has ID {} elsewhere'.format(key, column_id))
+                self._ids[key] = column_id
+                self._keys[column_id] = key
+                self._web[key] = col[4]
+
+    def column_id(self, column):
+        """
+        Look up the ID of a column given as a tuple of its MultiIndex labels.
+        Raises KeyError for unknown columns.
+
+        """
+        key = tuple(column[:4])
+        if key not in self._ids and key in self._web:
+            self.assign_ids()
+        return self._ids[key]
+
+    def column_ids(self, columns):
+        """
+        Return the list of IDs for the columns of a MultiIndex, registering
+        the ones not known yet.
+
+        """
+        for col in columns:
+            self.register(*col[:5])
+        return [self.column_id(col) for col in columns]
+
+    def key(self, column_id):
+        """Return the (variable, region, attribute, source) tuple for an ID."""
+        return self._keys[column_id]
+
+    def make_columns(self, tuples, headers):
+        """
+        Register the columns given as tuples of
+        (variable, region, attribute, source, web) and build their
+        MultiIndex in canonical order. Returns the MultiIndex and the
+        positions of ``tuples`` in that order.
+
+        Parameters
+        ----------
+        tuples : list of tuple
+            Column labels in the order the data arrives in.
+        headers : list
+            List of strings indicating the level names of the
+            pandas.MultiIndex for the columns of the dataframe.
+
+        """
+        keys = []
+        for t in tuples:
+            self.register(*t)
+            keys.append(t[:4])
+        order = sorted(range(len(keys)), key=lambda i: keys[i])
+        columns = pd.MultiIndex.from_tuples(
+            [keys[i] + (self._web[keys[i]],) for i in order],
+            names=headers
+        )
+        return columns, order
+
+    def label(self, df, tuples, headers):
+        """
+        Attach the columns given as tuples to ``df``, whose columns are in
+        the same order as ``tuples``, and rearrange them into canonical
+        order. Returns a pandas.DataFrame.
+
+        """
+        if len(tuples) != df.shape[1]:
+            raise ValueError(
+                'Length mismatch: frame has {} columns, got {} labels'
+                .format(df.shape[1], len(tuples))
+            )
+        columns, order = self.make_columns(tuples, headers)
+        df = df.iloc[:, order]
+        df.columns = columns
+        return df
+
+    def sort_columns(self, df):
+        """
+        Bring the columns of ``df`` into canonical order so that slicing
+        with ``.loc`` does not hit the unsorted-MultiIndex path.
+        Returns a pandas.DataFrame.
+
+        """
+        if df.columns.is_monotonic_increasing:
+            return df
+        return df.sort_index(axis=1)
+
+    def load(self, path):
+        """Read catalog entries from a YAML file written by ``save``."""
+        with open(path, 'r') as f:
+            entries = yaml.safe_load(f.read()) or []
+        for entry in entries:
+            key = (entry['variable'], entry['region'],
+                   entry['attribute'], entry['source'])
+            self._ids[key] = entry['id']
+            self._keys[entry['id']] = key
+            self._web[key] = sys.intern(entry['web'])
+        logger.info('loaded %s columns from catalog %s', len(entries), path)
+
+    def save(self, path=None):
+        """Write the catalog to ``path`` or the path it was loaded from."""
+        path = path or self.path
+        self.assign_ids()
+        entries = [
+            {'id': i, 'variable': key[0], 'region': key[1],
+             'attribute': key[2], 'source': key[3], 'web': self._web[key]}
+            for key, i in sorted(self._ids.items(), key=lambda x: x[1])
+        ]
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            f.write(yaml.safe_dump(entries, default_flow_style=False))
+        os.replace(tmp_path, path)
+        logger.info('saved %s columns to catalog %s', len(entries), path)
+
+
+# Catalog shared by the read functions of this package.
+catalog = ColumnCatalog()
@@ -0,0 +1,103 @@
+"""
+Open Power System Data
+
+Timeseries Datapackage
+
+convert.py : one-time conversion of Excel sources to a fast binary format
+
+"""
+
+import hashlib
+import logging
+import os
+import shutil
+
+from .columns import catalog
+from .export import read_columnar, write_columnar
+
+logger = logging.getLogger('log')
+logger.setLevel('INFO')
+
+def file_checksum(filepath):
+    """
+    Compute the sha256 of a file given by path or as an open binary file,
+    which is left at its position. Returns a hex string.
+
+    """
+    checksum = hashlib.sha256()
+    if hasattr(filepath, 'read'):
+        position = filepath.tell()
+        for chunk in iter(lambda: filepath.read(1024 * 1024), b''):
+            checksum.update(chunk)
+        filepath.seek(position)
+    else:
+        with open(filepath, 'rb') as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b''):
+                checksum.update(chunk)
+    return checksum.hexdigest()
+
+
+def _conversion_key(read_function, args):
+    """
+    Identify a conversion by the read function, its code and its further
+    arguments, so that changing any of them invalidates earlier results.
+
+    """
+    code = read_function.__code__
+    key = hashlib.sha256()
+    key.update(read_function.__name__.encode())
+    key.update(code.co_code)
+    key.update(repr(code.co_consts).encode())
+    key.update(repr(args).encode())
+    return key.hexdigest()[:16]
+
+
+def converted(read_function, filepath, *args, cache_dir=None):
+    """
+    Return ``read_function(filepath, *args)``, parsing the workbook only the
+    first time it is seen. The normalized result is stored in cache_dir
+    under the checksum of the file, from where later calls load it.
+    Returns a pandas.DataFrame.
+
+    Parameters
+    ----------
+    read_function : function
+        One of the read functions for Excel sources, e.g. ``read_entso``.
+    filepath : str or file-like
+        The downloaded workbook.
+    args
+        Further arguments to read_function, e.g. web and headers.
+    cache_dir : str, optional
+        Directory for converted files. If None, the workbook is parsed
+        every time.
+
+    """
+    if cache_dir is None:
+        return read_function(filepath, *args)
+
+    checksum = file_checksum(filepath)
+    path = os.path.join(
+        cache_dir, checksum[:2],
+        '{}_{}'.format(checksum, _conversion_key(read_function, args))
+    )
+
+    if os.path.exists(path):
+        logger.info('loading converted file %s', path)
+        df = read_columnar(path, mmap=False)
+        for col in df.columns:
+            catalog.register(*col)
+        return df
+
+    df = read_function(filepath, *args)
+    try:
+        # Write to a temporary directory first, so that an interrupted
+        # conversion is not mistaken for a finished one.
+        tmp_path = path + '.tmp'
+        write_columnar(df.astype(float), tmp_path)
+        if os.path.exists(path):
+            shutil.rmtree(tmp_path)
+        else:
+            os.rename(tmp_path, path)
+    except (TypeError, ValueError) as e:
+        logger.info('could not convert %s: %s', getattr(filepath, 'name', filepath), e)
+    return df
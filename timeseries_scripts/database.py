@@ -0,0 +1,239 @@
+"""
+Open Power System Data
+
+Timeseries Datapackage
+
+database.py : write time series to an indexed SQLite database
+
+"""
+
+import logging
+import sqlite3
+
+import numpy as np
+
+from .columns import catalog
+
+logger = logging.getLogger('log')
+logger.setLevel('INFO')
+
+# Settings for bulk loading. The database is published as a single file, so
+# it keeps a rollback journal: the journal mode of WAL is stored in the file
+# and readers would then need write access to create the shared-memory file
+# next to it. Setting DELETE also converts files left in WAL mode earlier.
+PRAGMAS = [
+    'PRAGMA journal_mode=DELETE',
+    'PRAGMA synchronous=NORMAL',
+    'PRAGMA temp_store=MEMORY',
+    'PRAGMA cache_size=-200000',
+]
+
+# Native upserts are available from SQLite 3.24 on. Older versions replace
+# whole rows instead.
+HAS_UPSERT = sqlite3.sqlite_version_info >= (3, 24, 0)
+
+
+def connect(filepath, timeout=3600):
+    """
+    Open ``filepath`` with the bulk-loading pragmas applied and transactions
+    left to the caller. Returns a sqlite3.Connection.
+
+    """
+    conn = sqlite3.connect(filepath, timeout=timeout, isolation_level=None)
+    for pragma in PRAGMAS:
+        conn.execute(pragma)
+    return conn
+
+
+def _quote(name):
+    return '"{}"'.format(name.replace('"', '""'))
+
+
+def _epoch(index):
+    """Return the naive UTC timestamps of ``index`` as int64 epoch seconds."""
+    return index.values.astype('datetime64[s]').astype(np.int64)
+
+
+def _rows(stamps, values, chunksize):
+    """
+    Yield lists of row tuples (timestamp, value, ...) of at most
+    ``chunksize`` rows, with missing values as None.
+
+    """
+    for start in range(0, len(stamps), chunksize):
+        block = values[start:start + chunksize]
+        cells = block.astype(object)
+        cells[np.isnan(block)] = None
+        yield [
+            (stamp,) + tuple(row)
+            for stamp, row in zip(stamps[start:start + chunksize].tolist(),
+                                  cells.tolist())
+        ]
+
+
+def create_wide_table(conn, table, names):
+    """
+    Create ``table`` with an integer epoch-seconds ``timestamp`` primary key
+    and one REAL column per name, or add the columns missing from an
+    existing table. Returns None.
+
+    """
+    conn.execute(
+        'CREATE TABLE IF NOT EXISTS {} (timestamp INTEGER PRIMARY KEY)'
+        .format(_quote(table))
+    )
+    existing = {row[1] for row in
+                conn.execute('PRAGMA table_info({})'.format(_quote(table)))}
+    for name in names:
+        if name not in existing:
+            conn.execute('ALTER TABLE {} ADD COLUMN {} REAL'
+                         .format(_quote(table), _quote(name)))
+
+
+def create_long_table(conn, table):
+    """
+    Create the normalized ``table`` (column_id, timestamp, value), keyed and
+    clustered by (column_id, timestamp), together with the ``columns``
+    table describing each column_id. Returns None.
+
+    """
+    conn.execute(
+        'CREATE TABLE IF NOT EXISTS columns ('
+        'column_id INTEGER PRIMARY KEY, name TEXT, variable TEXT, '
+        'region TEXT, attribute TEXT, source TEXT, web TEXT)'
+    )
+    conn.execute(
+        'CREATE TABLE IF NOT EXISTS {} ('
+        'column_id INTEGER NOT NULL, timestamp INTEGER NOT NULL, value REAL, '
+        'PRIMARY KEY (column_id, timestamp)) WITHOUT ROWID'
+        .format(_quote(table))
+    )
+
+
+def write_wide(conn, df, table, names, chunksize=50000):
+    """
+    Insert or update the rows of ``df`` in ``table``, whose columns are
+    given by ``names``. Returns None.
+
+    """
+    create_wide_table(conn, table, names)
+    quoted = [_quote(name) for name in names]
+    sql = 'INSERT {} INTO {} (timestamp, {}) VALUES ({})'.format(
+        '' if HAS_UPSERT else 'OR REPLACE',
+        _quote(table), ', '.join(quoted), ', '.join('?' * (len(names) + 1))
+    )
+    if HAS_UPSERT:
+        # Only touch the columns given, so other columns keep their values.
+        sql += ' ON CONFLICT(timestamp) DO UPDATE SET {}'.format(
+            ', '.join('{0} = excluded.{0}'.format(q) for q in quoted))
+
+    values = np.asarray(df.values, dtype=np.float64)
+    for rows in _rows(_epoch(df.index), values, chunksize):
+        conn.executemany(sql, rows)
+
+
+def column_ids(conn, columns, replace=False):
+    """
+    Look up the IDs of ``columns`` in the column catalog (see columns.py)
+    and describe the ones not yet in the ``columns`` table there. If the
+    table gives an ID another meaning, e.g. in a database written before
+    the catalog was kept, its row is replaced if ``replace`` is True and
+    ValueError is raised otherwise. Returns a list.
+
+    """
+    known = {
+        row[0]: tuple(row[1:]) for row in conn.execute(
+            'SELECT column_id, variable, region, attribute, source '
+            'FROM columns')
+    }
+    ids = catalog.column_ids(columns)
+    for column_id, col in zip(ids, columns):
+        key = tuple(col[0:4])
+        if column_id not in known:
+            conn.execute(
+                'INSERT INTO columns VALUES (?, ?, ?, ?, ?, ?, ?)',
+                (column_id, '_'.join(col[0:3])) + tuple(col[0:5])
+            )
+            known[column_id] = key
+        elif known[column_id] != key and replace:
+            conn.execute(
+                'INSERT OR REPLACE INTO columns VALUES (?, ?, ?, ?, ?, ?, ?)',
+                (column_id, '_'.join(col[0:3])) + tuple(col[0:5])
+            )
+        elif known[column_id] != key:
+            raise ValueError(
+                'column_id {} is {} in the database, but {} in the catalog, '
+                'write with replace=True to rebuild it'
+                .format(column_id, known[column_id], key))
+    return ids
+
+
+def write_long(conn, df, table, chunksize=50000, replace=False):
+    """
+    Insert or update the non-missing values of ``df`` in the normalized
+    ``table``. With ``replace``, outdated descriptions of its columns are
+    replaced, see column_ids. Returns None.
+
+    """
+    create_long_table(conn, table)
+    stamps = _epoch(df.index)
+    sql = 'INSERT OR REPLACE INTO {} (column_id, timestamp, value) ' \
+          'VALUES (?, ?, ?)'.format(_quote(table))
+    for j, column_id in enumerate(column_ids(conn, df.columns, replace)):
+        values = np.asarray(df.iloc[:, j].values, dtype=np.float64)
+        present = np.flatnonzero(~np.isnan(values))
+        for start in range(0, len(present), chunksize):
+            rows = present[start:start + chunksize]
+            conn.executemany(sql, zip(
+                [column_id] * len(rows),
+                stamps[rows].tolist(),
+                values[rows].tolist()
+            ))
+
+
+def write_sqlite(df, filepath, table, replace=False, long_table=False):
+    """
+    Write ``df`` to an SQLite database in a single transaction. By default,
+    rows for timestamps already in the database are updated and new ones
+    appended, so new periods can be added incrementally. Returns None.
+
+    Parameters
+    ----------
+    df : pandas.DataFrame
+        Frame with a naive UTC DatetimeIndex and a MultiIndex of columns.
+    filepath : str
+        Path of the database file.
+    table : str
+        Name of the wide table, e.g. ``timeseries15min``. Its columns are
+        named ``variable_region_attribute``.
+    replace : bool
+        If True, drop existing tables first instead of updating them.
+    long_table : bool
+        If True, also write the values to the normalized table
+        ``<table>_long``, indexed by (column_id, timestamp).
+
+    """
+    names = ['_'.join(col[0:3]) for col in df.columns]
+    long_name = table + '_long'
+
+    conn = connect(filepath)
+    try:
+        # Take the write lock up front, so that concurrent writers of other
+        # tables in the same file wait instead of failing on upgrade.
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            if replace:
+                conn.execute('DROP TABLE IF EXISTS {}'.format(_quote(table)))
+                if long_table:
+                    conn.execute('DROP TABLE IF EXISTS {}'
+                                 .format(_quote(long_name)))
+            write_wide(conn, df, table, names)
+            if long_table:
+                write_long(conn, df, long_name, replace=replace)
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+        conn.execute('COMMIT')
+        logger.info('wrote %s rows to %s in %s', len(df), table, filepath)
+    finally:
+        conn.close()
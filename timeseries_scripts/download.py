@@ -11,16 +11,49 @@ import argparse
 from datetime import datetime, date, time, timedelta
 from pytz import timezone as tz
 import getpass
+import hashlib
 import logging
 import os
+import re
+import threading
+import timeit
+from urllib.parse import urlparse
 
 import pandas as pd
 import requests
 import yaml
 
+try:
+    from . import profiling
+    from .profiling import profiled
+except ImportError:
+    # Run as a script, e.g. python timeseries_scripts/download.py, which
+    # puts this directory on the path instead of the package.
+    import profiling
+    from profiling import profiled
+
 logger = logging.getLogger('log')
 logger.setLevel('INFO')
 
+# Size of the chunks in which responses are streamed to disk.
+CHUNK_SIZE = 1024 * 1024
+
+# Unfinished downloads are kept here, outside of the per-period containers,
+# so that they are resumed on the next attempt instead of being read.
+PARTIAL_DIR = '.partial'
+
+# Leading bytes of the binary file types we download. Some servers send
+# xlsx or XML spreadsheets for files labelled xls and vice versa.
+MAGIC_BYTES = {
+    'xls': [b'\xd0\xcf\x11\xe0\xa1\xb1\x1a\xe1', b'PK\x03\x04', b'<?xml'],
+    'xlsx': [b'PK\x03\x04', b'\xd0\xcf\x11\xe0\xa1\xb1\x1a\xe1', b'<?xml'],
+    'zip': [b'PK\x03\x04'],
+}
+
+# Bytes downloaded, seconds spent and files fetched, by host.
+throughput = {}
+_throughput_lock = threading.Lock()
+
 
 def get_opsd_beta_password():
     if 'MORPH_OPSD_BETA_PW' in os.environ:
@@ -30,12 +63,188 @@ def get_opsd_beta_password():
     return password
 
 
+def sniff_content(head, filetype):
+    """
+    Check whether the first bytes of a download look like a file of the
+    expected type. Returns None if so, else a string describing the problem.
+
+    Parameters
+    ----------
+    head : bytes
+        The first few KB of the response body.
+    filetype : str
+        Expected type from sources.yml, e.g. ``csv`` or ``xls``.
+
+    """
+    if not head:
+        return 'empty response'
+    start = head.lstrip()[:64].lower()
+    if start.startswith((b'<!doctype html', b'<html', b'<head')):
+        return 'server sent an HTML page instead of a {} file'.format(filetype)
+    if filetype in MAGIC_BYTES:
+        if not head.lstrip().startswith(tuple(MAGIC_BYTES[filetype])):
+            return 'no {} signature at start of file'.format(filetype)
+    elif filetype == 'csv' and b'\x00' in head:
+        return 'binary data in csv file'
+    return None
+
+
+def _record_throughput(url, size, seconds):
+    host = urlparse(url).netloc
+    with _throughput_lock:
+        stats = throughput.setdefault(
+            host, {'bytes': 0, 'seconds': 0.0, 'files': 0})
+        stats['bytes'] += size
+        stats['seconds'] += seconds
+        stats['files'] += 1
+
+
+def throughput_report():
+    """
+    Summarize the download throughput per host in this session.
+    Returns a pandas.DataFrame.
+
+    """
+    with _throughput_lock:
+        df = pd.DataFrame.from_dict(throughput, orient='index')
+    if not df.empty:
+        df['MB/s'] = df['bytes'] / df['seconds'].clip(lower=1e-6) / 1e6
+    return df
+
+
+def _validator(resp):
+    """
+    Return the value for an If-Range header that identifies the content of
+    resp, a strong ETag or else the Last-Modified date, or None.
+
+    """
+    etag = resp.headers.get('ETag')
+    # Weak ETags must not be used for ranges.
+    if etag and not etag.startswith('W/'):
+        return etag
+    return resp.headers.get('Last-Modified')
+
+
+def _resumed_range(resp, offset):
+    """
+    Check that a partial response continues the file at offset. Returns
+    the total size of the file from its Content-Range, or None.
+
+    """
+    match = re.match(r'bytes (\d+)-\d+/(\d+|\*)',
+                     resp.headers.get('Content-Range', ''))
+    if not match or int(match.group(1)) != offset:
+        raise ValueError('server sent range {!r} when resuming at {}'.format(
+            resp.headers.get('Content-Range'), offset))
+    return None if match.group(2) == '*' else int(match.group(2))
+
+
+def _fetch(session, url, url_params, partial_path, filetype):
+    """
+    Stream a response into partial_path, resuming from the bytes already
+    there with an HTTP Range request. Returns the response and the sha256
+    of the complete file.
+
+    A download is only resumed if the server identified its content with
+    an ETag or Last-Modified date, which is sent back as If-Range: if the
+    content has changed since, the server sends the whole new file instead
+    of appending new bytes to the old part. Many sources generate their
+    files on each request without such a validator, so these start over.
+
+    Raises ValueError if the start of a new file does not look like the
+    expected filetype, see ``sniff_content``, or if a resumed download does
+    not fit the part on disk.
+
+    """
+    validator_path = partial_path + '.validator'
+    offset = os.path.getsize(partial_path) if os.path.exists(partial_path) else 0
+    validator = None
+    if offset and os.path.exists(validator_path):
+        with open(validator_path, 'r') as f:
+            validator = f.read().strip() or None
+    if validator is None:
+        offset = 0
+
+    headers = {}
+    if offset:
+        headers = {'Range': 'bytes={}-'.format(offset), 'If-Range': validator}
+    resp = session.get(url, params=url_params, headers=headers, stream=True)
+
+    if offset and resp.status_code == 416:
+        # The part on disk does not fit the file on the server anymore.
+        resp.close()
+        os.remove(partial_path)
+        return _fetch(session, url, url_params, partial_path, filetype)
+    resp.raise_for_status()
+
+    total = None
+    checksum = hashlib.sha256()
+    if offset and resp.status_code == 206:
+        total = _resumed_range(resp, offset)
+        logger.info('Resuming download after %s bytes', offset)
+        # The checksum has to cover the part downloaded before.
+        with open(partial_path, 'rb') as f:
+            for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+                checksum.update(chunk)
+        mode = 'ab'
+    else:
+        # The server sent the whole file, e.g. because it has changed.
+        offset = 0
+        mode = 'wb'
+        validator = _validator(resp)
+        if validator:
+            with open(validator_path, 'w') as f:
+                f.write(validator)
+        elif os.path.exists(validator_path):
+            os.remove(validator_path)
+
+    started = timeit.default_timer()
+    size = 0
+    with open(partial_path, mode) as output_file:
+        for chunk in resp.iter_content(CHUNK_SIZE):
+            if size == 0 and offset == 0:
+                # Give up on error pages before downloading all of them.
+                problem = sniff_content(chunk[:4096], filetype)
+                if problem:
+                    resp.close()
+                    raise ValueError(problem)
+            checksum.update(chunk)
+            output_file.write(chunk)
+            size += len(chunk)
+    _record_throughput(resp.url, size, timeit.default_timer() - started)
+
+    if total is not None and offset + size != total:
+        raise ValueError('resumed file has {} bytes, server announced {}'
+                         .format(offset + size, total))
+    # The file is complete, a new attempt has to start over.
+    if os.path.exists(validator_path):
+        os.remove(validator_path)
+
+    return resp, checksum.hexdigest()
+
+
+def container_name(start, end):
+    """Return the name of the directory for the file of a period."""
+    return start.strftime('%Y-%m-%d') + '_' + end.strftime('%Y-%m-%d')
+
+
+def _file_key(source_name, variable_name, out_path, param_dict, start, end,
+              session=None, archive=None):
+    return '/'.join([source_name, variable_name, container_name(start, end)])
+
+
+@profiled('download', key=_file_key)
 def download_file(source_name, variable_name, out_path,
-                  param_dict, start, end, session=None):
+                  param_dict, start, end, session=None, archive=None):
     """
     Download a single file specified by ``param_dict``, ``start``, ``end``,
     and save it to a directory constructed by combining ``source_name``,
-    ``variable_name`` and ``out_path``. Returns None.
+    ``variable_name`` and ``out_path``. Returns the path of the file, or
+    None if the file is in the archive.
+
+    Raises requests.RequestException if the download fails, keeping the
+    partial file to resume from, and ValueError if the response is rejected
+    or the directory holds more than one file.
 
     Parameters
     ----------
@@ -53,8 +262,16 @@ def download_file(source_name, variable_name, out_path,
         end of data in the file
     session : requests.session, optional
         If not given, a new session is created.
+    archive : archive.Archive, optional
+        Files already in this archive are not downloaded again.
 
     """
+    if archive is not None and archive.has(source_name, variable_name,
+                                           container_name(start, end)):
+        logger.info('%s %s %s is archived already', source_name,
+                    variable_name, container_name(start, end))
+        return None
+
     if session is None:
         session = requests.session()
 
@@ -70,9 +287,7 @@ def download_file(source_name, variable_name, out_path,
     # Each file will be saved in a folder of its own, this allows us to preserve
     # the original filename when saving to disk.
     container = os.path.join(
-        out_path, source_name, variable_name,
-        start.strftime('%Y-%m-%d') + '_' +
-        end.strftime('%Y-%m-%d')
+        out_path, source_name, variable_name, container_name(start, end)
     )
     os.makedirs(container, exist_ok=True)    
     
@@ -111,8 +326,26 @@ def download_file(source_name, variable_name, out_path,
 
     # Attempt the download if there is no file yet.
     count_files = len(os.listdir(container))
+    filepath = None
     if count_files == 0:
-        resp = session.get(url, params=url_params)
+        partial_path = os.path.join(
+            out_path, PARTIAL_DIR, source_name, variable_name,
+            os.path.basename(container)
+        )
+        os.makedirs(os.path.dirname(partial_path), exist_ok=True)
+        try:
+            resp, checksum = _fetch(session, url, url_params, partial_path,
+                                    param_dict['filetype'])
+        except requests.RequestException as e:
+            logger.info('Download failed, the partial file is kept for '
+                        'resuming: %s', e)
+            raise
+        except ValueError as e:
+            logger.info('Rejected download from URL: %s (%s)', url, e)
+            for path in [partial_path, partial_path + '.validator']:
+                if os.path.exists(path):
+                    os.remove(path)
+            raise
         
         # Get the original filename
         try:
@@ -134,50 +367,56 @@ def download_file(source_name, variable_name, out_path,
                 )
                 original_filename = 'data'
 
-        logger.info('Downloaded from URL: %s Original filename: %s',
-                     resp.url, original_filename)
+        logger.info('Downloaded from URL: %s Original filename: %s sha256: %s',
+                     resp.url, original_filename, checksum)
         
         #Save file to disk
         filepath = os.path.join(container, original_filename)
-        with open(filepath, 'wb') as output_file:
-            for chunk in resp.iter_content(1024):
-                output_file.write(chunk)
+        os.replace(partial_path, filepath)
 
     elif count_files == 1:
         logger.info('There is already a file: %s', os.listdir(container)[0])
+        filepath = os.path.join(container, os.listdir(container)[0])
 
     else:
         logger.info('There must not be more than one file in: %s. Please check ',
                      container)
+        raise ValueError('more than one file in {}'.format(container))
 
+    return filepath
 
-def download_source(source_name, source_dict, out_path, start_date=None, end_date=None):
+
+def source_session(source_name):
     """
-    Download all files for source_name as specified by the given
-    source_dict into out_path. Returns None.
+    Return the requests.session to download files for source_name with,
+    or None if no special session is needed.
+
+    """
+    # While OPSD is in beta, we need to supply authentication
+    if source_name == 'OPSD':
+        password = get_opsd_beta_password()
+        session = requests.session()
+        session.auth = ('beta', password)
+    else:
+        session = None
+    return session
+
+
+def download_tasks(source_dict, start_date=None, end_date=None):
+    """
+    List the files to download for a source as specified by the given
+    source_dict. Yields tuples of (variable_name, param_dict, start, end).
 
     Parameters
     ----------
-    source_name : str
-        Name of source dataset, e.g. ``TenneT``.
     source_dict : dict
         Dictionary of variables and their parameters for the given source.
-    out_path : str
-        Base download directory in which to save all downloaded files.
     start_date : datetime.date, optional
         Start of period for which to download the data.
     end_date : datetime.date, optional
         End of period for which to download the data
 
     """
-    # While OPSD is in beta, we need to supply authentication
-    if source_name == 'OPSD':
-        password = get_opsd_beta_password()
-        session = requests.session()
-        session.auth = ('beta', password)
-    else:
-        session = None
-        
     for variable_name, param_dict in source_dict.items():
         if param_dict['end'] == 'recent':
             param_dict['end'] = datetime.today().date()        
@@ -200,11 +439,7 @@ def download_source(source_name, source_dict, out_path, start_date=None, end_dat
                 
                 
         if param_dict['frequency'] in ['complete', 'irregular']:
-            download_file(
-                source_name, variable_name, out_path, param_dict,
-                start=param_dict['start'], end=param_dict['end'],
-                session=session
-            )
+            yield variable_name, param_dict, param_dict['start'], param_dict['end']
         
         else:
             # The files on the servers usually contain the data for subperiods
@@ -227,17 +462,83 @@ def download_source(source_name, source_dict, out_path, start_date=None, end_dat
                 ends = pd.DatetimeIndex([param_dict['end']])
     
             for s, e in zip(starts, ends):
-                download_file(
-                    source_name, variable_name, out_path, param_dict,
-                    start=s, end=e, session=session
-                )
+                yield variable_name, param_dict, s, e
 
 
-def download(sources_yaml_path, out_path, start_date=None, end_date=None, subset=None):
+def download_source(source_name, source_dict, out_path, start_date=None,
+                    end_date=None, archive=None):
+    """
+    Download all files for source_name as specified by the given
+    source_dict into out_path. A file that fails does not stop the others.
+    Returns a list of (name, exception) tuples of the files that failed.
+
+    Parameters
+    ----------
+    source_name : str
+        Name of source dataset, e.g. ``TenneT``.
+    source_dict : dict
+        Dictionary of variables and their parameters for the given source.
+    out_path : str
+        Base download directory in which to save all downloaded files.
+    start_date : datetime.date, optional
+        Start of period for which to download the data.
+    end_date : datetime.date, optional
+        End of period for which to download the data
+    archive : archive.Archive, optional
+        Files already in this archive are not downloaded again.
+
+    """
+    session = source_session(source_name)
+    errors = []
+    for variable_name, param_dict, start, end in download_tasks(
+            source_dict, start_date, end_date):
+        try:
+            download_file(
+                source_name, variable_name, out_path, param_dict,
+                start=start, end=end, session=session, archive=archive
+            )
+        except (requests.RequestException, ValueError) as e:
+            name = '{} {} {}'.format(source_name, variable_name,
+                                     container_name(start, end))
+            logger.info('error downloading %s: %s', name, e)
+            errors.append((name, e))
+    return errors
+
+
+def load_sources(sources_yaml_path, subset=None):
+    """
+    Load the YAML file with sources from disk. Returns a dict mapping each
+    source_name to its dictionary of variables.
+
+    Parameters
+    ----------
+    sources_yaml_path : str
+        Filepath of sources.yml
+    subset : list or iterable, optional
+        If given, only the sources named in subset are kept,
+        e.g.: ['TenneT', '50Hertz'].
+
+    """
+    with open(sources_yaml_path, 'r') as f:
+        sources = yaml.safe_load(f.read())
+
+    # If subset is given, only keep source_name keys in subset
+    if subset is not None:
+        sources = {k: v for k, v in sources.items() if k in subset}
+
+    return sources
+
+
+def download(sources_yaml_path, out_path, start_date=None, end_date=None, subset=None,
+             archive=None):
     """
     Load YAML file with sources from disk, and download all files for each
     source into the given out_path. Returns None.
 
+    Files that fail do not stop the others. Once all are done, a
+    RuntimeError listing the failed files is raised if there were any;
+    the next run resumes them.
+
     Parameters
     ----------
     sources_yaml_path : str
@@ -251,6 +552,9 @@ def download(sources_yaml_path, out_path, start_date=None, end_date=None, subset
     subset : list or iterable, optional
         If given, specifies a subset of data sources to download,
         e.g.: ['TenneT', '50Hertz'].
+    archive : archive.Archive, optional
+        Files already in this archive, e.g. moved there by ``archive_tree``,
+        are not downloaded again.
 
     """
     for name, date in {'end_date': end_date, 'start_date': start_date}.items():
@@ -260,23 +564,42 @@ def download(sources_yaml_path, out_path, start_date=None, end_date=None, subset
                         name, date, datetime.today().date())
             return
     
-    with open(sources_yaml_path, 'r') as f:
-        sources = yaml.load(f.read())
-
-    # If subset is given, only keep source_name keys in subset
-    if subset is not None:
-        sources = {k: v for k, v in sources.items() if k in subset}
+    sources = load_sources(sources_yaml_path, subset)
 
+    errors = []
     for source_name, source_dict in sources.items():
-        download_source(source_name, source_dict, out_path, start_date, end_date)
+        errors += download_source(source_name, source_dict, out_path,
+                                  start_date, end_date, archive)
+
+    # Do not let periods go missing silently, see pipeline.py.
+    if errors:
+        raise RuntimeError(
+            '{} files could not be downloaded:\n{}'.format(
+                len(errors),
+                '\n'.join('{}: {!r}'.format(name, e) for name, e in errors))
+        ) from errors[0][1]
+
+
+def _parse_date(value):
+    return datetime.strptime(value, '%Y-%m-%d').date()
 
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument('sources_yaml_path', type=str)
     parser.add_argument('out_path', type=str)
-    parser.add_argument('end_date', type=date)
+    parser.add_argument('end_date', type=_parse_date,
+                        help='last day to download, e.g. 2016-07-14')
     parser.add_argument('-s', '--subset', nargs='*', action='append')
+    parser.add_argument('--profile', type=str, default=None,
+                        help='directory to write profiles of each file to')
     args = parser.parse_args()
-
-    download(args.sources_yaml_path, args.out_path, args.subset)
+    if args.profile:
+        profiling.enable(args.profile)
+
+    # Each -s gives a list of sources.
+    subset = None
+    if args.subset:
+        subset = [name for names in args.subset for name in names]
+    download(args.sources_yaml_path, args.out_path, end_date=args.end_date,
+             subset=subset)
@@ -0,0 +1,379 @@
+"""
+Open Power System Data
+
+Timeseries Datapackage
+
+export.py : write the datapackage output files
+
+"""
+
+import json
+import logging
+import multiprocessing
+import os
+import shutil
+import tempfile
+import time
+
+import numpy as np
+import pandas as pd
+
+from .columns import catalog
+from .database import write_sqlite
+from .profiling import profiled
+
+logger = logging.getLogger('log')
+logger.setLevel('INFO')
+
+# Names the subdirectory of a columnar output that holds its current arrays.
+CURRENT_FILE = 'CURRENT'
+
+# Output variants written for each resolution, by format.
+OUTPUTS = {
+    'sqlite': ['singleindex'],
+    'xlsx': ['singleindex', 'multiindex'],
+    'csv': ['singleindex', 'multiindex', 'stacked'],
+    'npz': ['stacked'],
+    'npy': ['columnar'],
+}
+
+# Formats written unless others are asked for.
+DEFAULT_FORMATS = ['sqlite', 'xlsx', 'csv']
+
+DATE_FORMAT = '%Y-%m-%dT%H:%M:%SZ'
+FLOAT_FORMAT = '%.2f'
+
+
+def write_columnar(df, path, ids=None):
+    """
+    Save ``df`` as a directory of raw arrays that worker processes can
+    memory-map instead of receiving a pickled copy. Returns None.
+
+    The arrays are written to a new subdirectory of path, which the
+    ``CURRENT`` file is then switched to in one atomic rename. Files that
+    are memory-mapped by readers, e.g. the query service, are never
+    rewritten, so they keep seeing the previous version until they reopen
+    it. Older versions but the previous one are removed.
+
+    Parameters
+    ----------
+    df : pandas.DataFrame
+        Frame with a naive UTC DatetimeIndex and a MultiIndex of columns.
+    path : str
+        Directory to write ``values.npy``, ``index.npy`` and
+        ``columns.json`` to.
+    ids : list, optional
+        Catalog IDs of the columns, stored with them for other processes.
+
+    """
+    os.makedirs(path, exist_ok=True)
+    try:
+        previous = columnar_version(path)
+    except OSError:
+        previous = None
+    version_path = tempfile.mkdtemp(prefix='v', dir=path)
+    os.chmod(version_path, 0o755)
+
+    # Column-major layout, so every column is one contiguous block on disk.
+    np.save(os.path.join(version_path, 'values.npy'),
+            np.asfortranarray(df.values, dtype=np.float64))
+    np.save(os.path.join(version_path, 'index.npy'),
+            df.index.values.astype('datetime64[ns]').astype(np.int64))
+    with open(os.path.join(version_path, 'columns.json'), 'w') as f:
+        meta = {'names': list(df.columns.names),
+                'tuples': [list(col) for col in df.columns]}
+        if ids is not None:
+            meta['ids'] = [int(i) for i in ids]
+        json.dump(meta, f)
+
+    # Written last, so that readers only ever see complete versions.
+    tmp_path = os.path.join(path, CURRENT_FILE + '.tmp')
+    with open(tmp_path, 'w') as f:
+        f.write(os.path.basename(version_path))
+    os.replace(tmp_path, os.path.join(path, CURRENT_FILE))
+
+    # A reader may just have read the marker, so keep the previous version.
+    # Removing a file that is mapped leaves the mapping intact.
+    for name in os.listdir(path):
+        if name not in (os.path.basename(version_path), previous) \
+                and os.path.isdir(os.path.join(path, name)):
+            shutil.rmtree(os.path.join(path, name), ignore_errors=True)
+
+
+def columnar_version(path):
+    """
+    Return the name of the current version of a columnar output, which
+    changes every time it is written. Raises OSError if there is none.
+
+    """
+    with open(os.path.join(path, CURRENT_FILE), 'r') as f:
+        return f.read().strip()
+
+
+def read_columnar(path, mmap=True):
+    """
+    Load a frame written by ``write_columnar``. With ``mmap``, the values
+    stay on disk and are paged in as columns are accessed.
+    Returns a pandas.DataFrame.
+
+    """
+    mode = 'r' if mmap else None
+    path = os.path.join(path, columnar_version(path))
+    values = np.load(os.path.join(path, 'values.npy'), mmap_mode=mode)
+    index = np.load(os.path.join(path, 'index.npy'), mmap_mode=mode)
+    with open(os.path.join(path, 'columns.json'), 'r') as f:
+        meta = json.load(f)
+    columns = pd.MultiIndex.from_tuples(
+        [tuple(col) for col in meta['tuples']], names=meta['names'])
+    index = pd.DatetimeIndex(np.asarray(index).astype('datetime64[ns]'),
+                             name='timestamp')
+    return pd.DataFrame(values, index=index, columns=columns, copy=False)
+
+
+def singleindex(df):
+    """
+    Flatten the column MultiIndex to ``variable_region_attribute`` names.
+    Returns a pandas.DataFrame.
+
+    """
+    df = df.copy()
+    # use first 3 levels of multiindex to create singleindex
+    df.columns = ['_'.join(col[0:3]) for col in df.columns.values]
+    return df
+
+
+def multiindex(df):
+    """Return ``df`` unchanged, keeping all header rows."""
+    return df
+
+
+def write_stacked_csv(df, filepath, chunksize=100000):
+    """
+    Write ``df`` in long format with one row per non-missing value, going
+    through the columns one at a time so that neither a transposed copy of
+    ``df`` nor the full stacked series is ever held in memory. Returns None.
+
+    Parameters
+    ----------
+    df : pandas.DataFrame
+        Frame with a DatetimeIndex and a MultiIndex of columns.
+    filepath : str
+        CSV file to write.
+    chunksize : int
+        Maximum number of rows formatted at once.
+
+    """
+    stamps = np.asarray(df.index.strftime(DATE_FORMAT))
+    with open(filepath, 'w') as f:
+        f.write('variable,region,attribute,timestamp,data\n')
+        for j, col in enumerate(df.columns):
+            values = np.asarray(df.iloc[:, j].values, dtype=np.float64)
+            present = np.flatnonzero(~np.isnan(values))
+            for start in range(0, len(present), chunksize):
+                rows = present[start:start + chunksize]
+                chunk = pd.DataFrame({'timestamp': stamps[rows],
+                                      'data': values[rows]},
+                                     columns=['timestamp', 'data'])
+                for level, label in reversed(list(zip(
+                        ['variable', 'region', 'attribute'], col[0:3]))):
+                    chunk.insert(0, level, label)
+                chunk.to_csv(f, header=False, index=False,
+                             float_format=FLOAT_FORMAT)
+
+
+def write_stacked_npz(df, filepath):
+    """
+    Write ``df`` in long format to a compressed numpy archive holding one
+    array each for the column position, the timestamp (int64 nanoseconds
+    since the epoch, UTC) and the value of all non-missing entries, plus
+    the (variable, region, attribute) labels of the columns. Returns None.
+
+    """
+    stamps = df.index.values.astype('datetime64[ns]').astype(np.int64)
+    present = [np.flatnonzero(~np.isnan(np.asarray(df.iloc[:, j].values,
+                                                   dtype=np.float64)))
+               for j in range(df.shape[1])]
+    size = sum(len(rows) for rows in present)
+
+    column = np.empty(size, dtype=np.int32)
+    timestamp = np.empty(size, dtype=np.int64)
+    value = np.empty(size, dtype=np.float64)
+    pos = 0
+    for j, rows in enumerate(present):
+        end = pos + len(rows)
+        column[pos:end] = j
+        timestamp[pos:end] = stamps[rows]
+        value[pos:end] = df.iloc[:, j].values[rows]
+        pos = end
+
+    labels = np.array([list(col[0:3]) for col in df.columns], dtype=str)
+    np.savez_compressed(filepath, column=column, timestamp=timestamp,
+                        value=value, labels=labels)
+
+
+def read_stacked_npz(filepath):
+    """
+    Load a file written by ``write_stacked_npz``.
+    Returns a pandas.DataFrame with one row per value.
+
+    """
+    with np.load(filepath) as archive:
+        labels = archive['labels']
+        column = archive['column']
+        df = pd.DataFrame({
+            'variable': labels[column, 0],
+            'region': labels[column, 1],
+            'attribute': labels[column, 2],
+            'timestamp': archive['timestamp'].astype('datetime64[ns]'),
+            'data': archive['value'],
+        }, columns=['variable', 'region', 'attribute', 'timestamp', 'data'])
+    return df
+
+
+SHAPES = {
+    'singleindex': singleindex,
+    'multiindex': multiindex,
+}
+
+
+def output_path(out_path, res_key, shape, fmt):
+    """Return the file an output variant is written to."""
+    if fmt == 'sqlite':
+        return os.path.join(out_path, 'data.sqlite')
+    if fmt == 'npy':
+        # A directory of arrays, see write_columnar.
+        return os.path.join(out_path, 'timeseries{}_{}'.format(res_key, shape))
+    suffix = '' if shape == 'singleindex' else '_' + shape
+    return os.path.join(
+        out_path, 'timeseries{}{}.{}'.format(res_key, suffix, fmt))
+
+
+def write_output(df, res_key, shape, fmt, out_path, long_table=False):
+    """
+    Write one output variant of ``df`` to disk. Returns the file path.
+
+    Parameters
+    ----------
+    df : pandas.DataFrame
+        The dataset for one resolution.
+    res_key : str
+        Resolution of the dataset, e.g. ``15min``.
+    shape : str
+        One of ``singleindex``, ``multiindex``, ``stacked`` or ``columnar``.
+    fmt : str
+        One of ``csv``, ``xlsx``, ``sqlite``, ``npz`` or ``npy``.
+    out_path : str
+        Directory to write to.
+    long_table : bool
+        If True, the SQLite output also gets the normalized long table.
+
+    """
+    filepath = output_path(out_path, res_key, shape, fmt)
+
+    # The long format is written column by column, straight from the arrays.
+    if shape == 'stacked':
+        if fmt == 'csv':
+            write_stacked_csv(df, filepath)
+        elif fmt == 'npz':
+            write_stacked_npz(df, filepath)
+        else:
+            raise ValueError('no stacked output in format: {}'.format(fmt))
+        return filepath
+
+    if fmt == 'npy':
+        write_columnar(df, filepath)
+        return filepath
+
+    if fmt == 'sqlite':
+        write_sqlite(df, filepath, 'timeseries' + res_key,
+                     replace=True, long_table=long_table)
+        return filepath
+
+    df = SHAPES[shape](df)
+
+    if fmt == 'xlsx':
+        df.to_excel(filepath, float_format=FLOAT_FORMAT, merge_cells=False)
+    elif fmt == 'csv':
+        df.to_csv(filepath, float_format=FLOAT_FORMAT, date_format=DATE_FORMAT)
+    else:
+        raise ValueError('unknown output format: {}'.format(fmt))
+
+    return filepath
+
+
+def _export_job(job):
+    """
+    Run one output job in a worker process, reading the dataset from its
+    memory-mapped columnar copy. Returns (job, file path, seconds).
+
+    """
+    columnar_path, res_key, shape, fmt, out_path, long_table = job
+    started = time.time()
+    df = read_columnar(columnar_path)
+    # Use the column IDs of the parent process, see columns.py.
+    version_path = os.path.join(columnar_path, columnar_version(columnar_path))
+    with open(os.path.join(version_path, 'columns.json'), 'r') as f:
+        catalog.adopt(df.columns, json.load(f)['ids'])
+    filepath = write_output(df, res_key, shape, fmt, out_path, long_table)
+    return job, filepath, time.time() - started
+
+
+@profiled('export')
+def export(data_sets, out_path='.', formats=None, processes=None,
+           long_table=False):
+    """
+    Write all output variants of ``data_sets`` concurrently in a pool of
+    worker processes. Returns a dict mapping each written file (and SQLite
+    table) to the seconds it took.
+
+    Parameters
+    ----------
+    data_sets : dict
+        Maps resolutions, e.g. ``15min``, to the pandas.DataFrame to write.
+    out_path : str
+        Directory to write the output files to.
+    formats : list, optional
+        Subset of ``csv``, ``xlsx``, ``sqlite``, ``npz`` (compressed
+        long format) and ``npy`` (memory-mappable arrays, as read by the
+        query service). Defaults to ``DEFAULT_FORMATS``.
+    processes : int, optional
+        Number of worker processes. Defaults to the number of CPUs.
+    long_table : bool
+        If True, the SQLite output also gets the normalized long table.
+
+    """
+    formats = formats or DEFAULT_FORMATS
+    tmp_dir = tempfile.mkdtemp(prefix='opsd_export_')
+    timings = {}
+    try:
+        jobs = []
+        for res_key, df in data_sets.items():
+            if df.empty:
+                continue
+            columnar_path = os.path.join(tmp_dir, res_key)
+            write_columnar(df, columnar_path,
+                           ids=catalog.column_ids(df.columns))
+            for fmt in formats:
+                for shape in OUTPUTS[fmt]:
+                    jobs.append((columnar_path, res_key, shape, fmt, out_path,
+                                 long_table))
+
+        started = time.time()
+        with multiprocessing.Pool(processes) as pool:
+            for job, filepath, seconds in pool.imap_unordered(_export_job, jobs):
+                name = filepath
+                if job[3] == 'sqlite':
+                    name = '{}:timeseries{}'.format(filepath, job[1])
+                timings[name] = seconds
+                logger.info('wrote %s in %.1f s', name, seconds)
+        logger.info('exported %s outputs in %.1f s',
+                    len(jobs), time.time() - started)
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    # Keep the IDs given to columns added after reading, e.g. the sums for
+    # Germany.
+    if catalog.path is not None:
+        catalog.save()
+
+    return timings
@@ -0,0 +1,188 @@
+"""
+Open Power System Data
+
+Timeseries Datapackage
+
+fingerprint.py : recognize the layout of a file from its first few KB
+
+"""
+
+from collections import namedtuple
+import hashlib
+import logging
+
+logger = logging.getLogger('log')
+logger.setLevel('INFO')
+
+# Number of bytes read from the start of each file.
+HEAD_SIZE = 8192
+
+# Candidate delimiters of CSV files, in order of preference.
+DELIMITERS = [';', ',', '\t']
+
+Fingerprint = namedtuple(
+    'Fingerprint', ['kind', 'encoding', 'sep', 'columns', 'lines', 'digest'])
+
+# A layout a read function knows how to parse.
+#   name        identifies the layout in the log
+#   sep         field delimiter
+#   skiprows    number of non-empty lines before the first data line, the
+#               last of which holds the column names
+#   header      for each field the read function needs, a lowercase token
+#               its column name must contain, or None to accept any name
+#   date_field  position of a field that starts with a digit in data lines
+#   variables   variables the layout is used for, or None for all
+Layout = namedtuple(
+    'Layout',
+    ['name', 'sep', 'skiprows', 'header', 'date_field', 'variables'])
+
+# Known layouts of the CSV sources, registered per source in the order they
+# are tried. See the read functions in read.py for how they are parsed.
+LAYOUTS = {
+    '50Hertz': [Layout('50hertz', ';', 4, ('datum', None, None, 'mw'), 0, None)],
+    'Amprion': [
+        Layout('amprion', ';', 1, ('datum', None, 'prognose', None), 0, None),
+    ],
+    'TenneT': [
+        Layout('tennet-wind', ';', 4, ('datum', None, 'prognose', None, None),
+               0, ('wind',)),
+        Layout('tennet-solar', ';', 4, ('datum', None, 'prognose', None), 0,
+               ('solar',)),
+    ],
+    'TransnetBW': [
+        Layout('transnetbw', ';', 1,
+               (None, None, None, None, 'prognose', None), 2, None),
+    ],
+    'OPSD': [
+        Layout('opsd-capacities', ',', 1, (None, None, 'wind', 'solar'), 0,
+               None),
+    ],
+}
+
+
+def register_layout(source_name, layout):
+    """Add a layout to the ones tried for the files of source_name."""
+    LAYOUTS.setdefault(source_name, []).append(layout)
+
+
+def layouts(source_name, variable_name):
+    """Return the layouts registered for files of a source and variable."""
+    return [
+        layout for layout in LAYOUTS.get(source_name, [])
+        if layout.variables is None or variable_name in layout.variables
+    ]
+
+
+def _read_head(filepath, size):
+    if hasattr(filepath, 'read'):
+        position = filepath.tell()
+        head = filepath.read(size)
+        filepath.seek(position)
+        return head
+    with open(filepath, 'rb') as f:
+        return f.read(size)
+
+
+def fingerprint(filepath, skiprows=0, size=HEAD_SIZE):
+    """
+    Describe the format of a file from its first ``size`` bytes only.
+    Returns a Fingerprint with the kind of file (``csv``, ``xls``,
+    ``xlsx`` or ``empty``), its encoding and delimiter, the number of
+    fields in the first data line, the non-empty lines read and a digest
+    of the header lines, delimiter, encoding and field count.
+
+    Parameters
+    ----------
+    filepath : str or file-like
+        The downloaded file. Open files are left at their position.
+    skiprows : int
+        Number of non-empty header lines before the first data line.
+    size : int
+        Number of bytes to read.
+
+    """
+    head = _read_head(filepath, size)
+    if not head.strip():
+        return Fingerprint('empty', None, None, 0, [], None)
+    if head.startswith(b'\xd0\xcf\x11\xe0'):
+        return Fingerprint('xls', None, None, 0, [], None)
+    if head.startswith(b'PK\x03\x04'):
+        return Fingerprint('xlsx', None, None, 0, [], None)
+
+    if head.startswith(b'\xef\xbb\xbf'):
+        head = head[3:]
+    # The last line is probably cut off by the size limit.
+    if len(head) == size:
+        head = head[:head.rfind(b'\n') + 1] or head
+    try:
+        text, encoding = head.decode('utf-8'), 'utf-8'
+    except UnicodeDecodeError:
+        text, encoding = head.decode('latin_1'), 'latin_1'
+    lines = [line.strip() for line in text.splitlines() if line.strip()]
+
+    # Take the delimiter that splits the data lines into most fields.
+    data = lines[skiprows:] or lines
+    sep = max(DELIMITERS, key=lambda d: (min(l.count(d) for l in data[:10]),
+                                         -DELIMITERS.index(d)))
+    columns = data[0].count(sep) + 1
+
+    digest = hashlib.sha1()
+    for line in lines[:skiprows]:
+        digest.update(line.lower().encode('utf-8') + b'\n')
+    digest.update('{}|{}|{}'.format(sep, encoding, columns).encode('utf-8'))
+
+    return Fingerprint('csv', encoding, sep, columns, lines,
+                       digest.hexdigest()[:12])
+
+
+def _fields(line, sep):
+    return [field.strip('"\' ').lower() for field in line.split(sep)]
+
+
+def _matches(fp, layout):
+    if fp.kind != 'csv' or fp.sep != layout.sep:
+        return False
+    data = fp.lines[layout.skiprows:]
+    if not data or not layout.skiprows:
+        return False
+    # Columns that were renamed or moved keep the field count, so compare
+    # the column names the read function relies on, too.
+    names = _fields(fp.lines[layout.skiprows - 1], layout.sep)
+    if len(names) < len(layout.header):
+        return False
+    for name, token in zip(names, layout.header):
+        if token is not None and token not in name:
+            return False
+    for line in data[:10]:
+        if len(line.split(layout.sep)) < len(layout.header):
+            return False
+    first = _fields(data[0], layout.sep)[layout.date_field]
+    return first[:1].isdigit()
+
+
+def identify(source_name, variable_name, filepath):
+    """
+    Find the registered layout of source_name that matches the start of the
+    file, before any expensive parsing: the delimiter, the number of fields
+    and the column names of the header line the read function relies on.
+    Returns the Layout, to be passed on to the read function, or None if no
+    layout matches. Sources without registered layouts always give None.
+
+    """
+    candidates = layouts(source_name, variable_name)
+    for layout in candidates:
+        fp = fingerprint(filepath, layout.skiprows)
+        if _matches(fp, layout):
+            logger.info('layout %s, fingerprint %s', layout.name, fp.digest)
+            return layout
+
+    if candidates:
+        fp = fingerprint(filepath)
+        header_lines = max(layout.skiprows for layout in candidates)
+        logger.info(
+            'no known layout of %s %s matches: kind %s, encoding %s, '
+            'delimiter %r, %s fields, fingerprint %s, first lines %r',
+            source_name, variable_name, fp.kind, fp.encoding, fp.sep,
+            fp.columns, fp.digest, fp.lines[:header_lines]
+        )
+    return None
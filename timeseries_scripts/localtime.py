@@ -0,0 +1,197 @@
+"""
+Open Power System Data
+
+Timeseries Datapackage
+
+localtime.py : local-time calendar and aggregations of UTC time series
+
+"""
+
+from collections import namedtuple
+import logging
+
+import numpy as np
+import pandas as pd
+import pytz
+
+logger = logging.getLogger('log')
+logger.setLevel('INFO')
+
+NS_PER_MINUTE = 60 * 10**9
+NS_PER_DAY = 24 * 60 * NS_PER_MINUTE
+
+# Hours of the day (local time, Monday to Friday) counted as peak load.
+PEAK_HOURS = (8, 20)
+
+# Local calendar position of every entry of a UTC index, as int arrays.
+#   offset  UTC offset in minutes
+#   day     local day, counted in days since 1970-01-01
+#   month   local month, counted in months since 1970-01
+#   hour    local hour of the day
+#   weekday local day of the week, Monday is 0
+LocalCalendar = namedtuple(
+    'LocalCalendar', ['offset', 'day', 'month', 'hour', 'weekday'])
+
+# Calendars computed so far, by zone and index.
+_calendars = {}
+
+
+def utc_offsets(values, zone):
+    """
+    Look up the UTC offset in minutes of each UTC timestamp in values
+    (int64 nanoseconds) from the transition table of the time zone, without
+    converting any timestamp. Returns an int16 numpy.ndarray.
+
+    """
+    tz = pytz.timezone(zone)
+    transitions = getattr(tz, '_utc_transition_times', None)
+    if not transitions:
+        minutes = int(tz.utcoffset(None).total_seconds() // 60) \
+            if hasattr(tz, 'utcoffset') else 0
+        return np.full(len(values), minutes, dtype=np.int16)
+
+    starts = np.array(transitions, dtype='datetime64[ns]').astype(np.int64)
+    minutes = np.array(
+        [info[0].total_seconds() // 60 for info in tz._transition_info],
+        dtype=np.int16
+    )
+    pos = np.searchsorted(starts, values, side='right') - 1
+    return minutes[np.clip(pos, 0, len(minutes) - 1)]
+
+
+def local_calendar(index, zone='Europe/Brussels'):
+    """
+    Map each entry of a naive UTC DatetimeIndex onto the local calendar of
+    zone. The result is cached, so repeated queries on the same index do
+    not convert it again. Returns a LocalCalendar.
+
+    """
+    values = index.values.astype('datetime64[ns]').astype(np.int64)
+    key = (zone, len(values),
+           int(values[0]) if len(values) else 0,
+           int(values[-1]) if len(values) else 0,
+           getattr(index, 'freqstr', None))
+    if key in _calendars:
+        return _calendars[key]
+
+    offset = utc_offsets(values, zone)
+    local = values + offset.astype(np.int64) * NS_PER_MINUTE
+    day = np.floor_divide(local, NS_PER_DAY)
+    calendar = LocalCalendar(
+        offset=offset,
+        day=day.astype(np.int32),
+        month=local.astype('datetime64[ns]').astype('datetime64[M]')
+                   .astype(np.int32),
+        hour=((local - day * NS_PER_DAY) // (60 * NS_PER_MINUTE))
+             .astype(np.int8),
+        # 1970-01-01 was a Thursday.
+        weekday=((day + 3) % 7).astype(np.int8),
+    )
+    # Only regular indexes are identified by their ends and length.
+    if key[-1] is not None:
+        _calendars[key] = calendar
+    return calendar
+
+
+def local_timestamps(index, zone='Europe/Brussels'):
+    """
+    Return the local wall-clock time of each entry of a naive UTC
+    DatetimeIndex as a naive DatetimeIndex, e.g. for a ``cet-timestamp``
+    column.
+
+    """
+    calendar = local_calendar(index, zone)
+    values = index.values.astype('datetime64[ns]').astype(np.int64)
+    local = values + calendar.offset.astype(np.int64) * NS_PER_MINUTE
+    return pd.DatetimeIndex(local.astype('datetime64[ns]'))
+
+
+def _reduce(values, codes, how):
+    """
+    Aggregate the rows of values over runs of equal codes, skipping NaN.
+    Returns the distinct codes and an array with one row per code.
+
+    """
+    if len(codes) and (np.diff(codes) < 0).any():
+        order = np.argsort(codes, kind='mergesort')
+        codes, values = codes[order], values[order]
+    starts = np.concatenate([[0], np.flatnonzero(np.diff(codes)) + 1])
+    if len(codes) == 0:
+        return codes, values[:0]
+
+    present = ~np.isnan(values)
+    if how in ('sum', 'mean'):
+        sums = np.add.reduceat(np.where(present, values, 0), starts, axis=0)
+        counts = np.add.reduceat(present, starts, axis=0)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            result = sums / counts if how == 'mean' else sums
+        result[counts == 0] = np.nan
+    elif how == 'min':
+        result = np.fmin.reduceat(values, starts, axis=0)
+    elif how == 'max':
+        result = np.fmax.reduceat(values, starts, axis=0)
+    else:
+        raise ValueError('unknown aggregation: {}'.format(how))
+    return codes[starts], result
+
+
+def _period_index(codes, freq):
+    if freq == 'D':
+        stamps = codes.astype('datetime64[D]')
+    elif freq == 'M':
+        stamps = codes.astype('datetime64[M]')
+    else:
+        raise ValueError('freq must be D or M, got {}'.format(freq))
+    return pd.DatetimeIndex(stamps.astype('datetime64[ns]'), name='local_date')
+
+
+def aggregate(df, freq='D', how='mean', zone='Europe/Brussels'):
+    """
+    Aggregate a frame with a naive UTC DatetimeIndex by local calendar day
+    or month, for all columns at once. Returns a pandas.DataFrame indexed by
+    the local date of the first day of each period.
+
+    Parameters
+    ----------
+    df : pandas.DataFrame
+        Data with a naive UTC DatetimeIndex, e.g. ``data_sets['60min']``.
+    freq : str
+        ``D`` for local days or ``M`` for local months.
+    how : str
+        One of ``mean``, ``sum``, ``min`` or ``max``. Missing values are
+        skipped.
+    zone : str
+        Name of the time zone, e.g. ``Europe/Brussels`` for CET/CEST.
+
+    """
+    calendar = local_calendar(df.index, zone)
+    codes = calendar.day if freq == 'D' else calendar.month
+    codes, result = _reduce(np.asarray(df.values, dtype=np.float64),
+                            codes, how)
+    return pd.DataFrame(result, index=_period_index(codes, freq),
+                        columns=df.columns)
+
+
+def peak_offpeak(df, freq='M', how='mean', zone='Europe/Brussels',
+                 peak_hours=PEAK_HOURS):
+    """
+    Aggregate a frame with a naive UTC DatetimeIndex separately for peak
+    hours (Monday to Friday, peak_hours in local time) and off-peak hours of
+    each local day or month. Returns a pandas.DataFrame indexed by local
+    date and ``peak``/``offpeak``.
+
+    """
+    calendar = local_calendar(df.index, zone)
+    is_peak = ((calendar.weekday < 5) &
+               (calendar.hour >= peak_hours[0]) &
+               (calendar.hour < peak_hours[1]))
+    period = calendar.day if freq == 'D' else calendar.month
+    codes = period.astype(np.int64) * 2 + is_peak
+    codes, result = _reduce(np.asarray(df.values, dtype=np.float64),
+                            codes, how)
+    index = pd.MultiIndex.from_arrays(
+        [_period_index(codes // 2, freq),
+         np.where(codes % 2 == 1, 'peak', 'offpeak')],
+        names=['local_date', 'hours']
+    )
+    return pd.DataFrame(result, index=index, columns=df.columns)
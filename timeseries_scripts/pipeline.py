@@ -0,0 +1,203 @@
+"""
+Open Power System Data
+
+Timeseries Datapackage
+
+pipeline.py : download and read time series files in one overlapped pass
+
+"""
+
+from datetime import datetime
+import logging
+import os
+import queue
+import threading
+import time
+
+import pandas as pd
+
+from .columns import CATALOG_FILE, catalog
+from .download import container_name, download_file, download_tasks, load_sources, source_session
+from .read import fill_gaps, merge, read_file
+
+logger = logging.getLogger('log')
+logger.setLevel('INFO')
+
+# Put on the queue by the downloader once all files are listed.
+_DONE = object()
+
+
+def _downloader(sources, out_path, start_date, end_date, files, errors,
+                archive=None):
+    """
+    Download all files of sources one after another, putting each finished
+    file on the files queue. Files in archive are put on the queue without
+    downloading them. Blocks while the queue is full. A file that fails is
+    recorded in errors and the next one is downloaded. Returns None.
+
+    """
+    seq = 0
+    try:
+        for source_name, source_dict in sources.items():
+            try:
+                session = source_session(source_name)
+                tasks = list(download_tasks(source_dict, start_date, end_date))
+            except Exception as e:
+                logger.info('error listing files of %s: %s', source_name, e)
+                errors.append((source_name, e))
+                continue
+            for variable_name, param_dict, start, end in tasks:
+                container = container_name(start, end)
+                if archive is not None and archive.has(
+                        source_name, variable_name, container):
+                    files.put((seq, source_name, variable_name, param_dict,
+                               None, container))
+                    seq += 1
+                    continue
+                try:
+                    filepath = download_file(
+                        source_name, variable_name, out_path, param_dict,
+                        start=start, end=end, session=session
+                    )
+                except Exception as e:
+                    name = '{} {} {}-{}'.format(source_name, variable_name,
+                                                start, end)
+                    logger.info('error downloading %s: %s', name, e)
+                    errors.append((name, e))
+                    continue
+                files.put((seq, source_name, variable_name, param_dict,
+                           filepath, container))
+                seq += 1
+    finally:
+        files.put(_DONE)
+
+
+def _reader(files, results, headers, cache_dir, errors, archive=None):
+    """
+    Read files from the queue until the downloader is done, collecting the
+    frames in results. Files without a path are read from archive.
+    Returns None.
+
+    """
+    while True:
+        item = files.get()
+        if item is _DONE:
+            # Let the other readers see the end of the queue, too.
+            files.put(_DONE)
+            return
+        seq, source_name, variable_name, param_dict, filepath, container = item
+        try:
+            if filepath is None:
+                filepath = '/'.join([source_name, variable_name, container])
+                with archive.open(source_name, variable_name, container) as f:
+                    data_to_add = read_file(source_name, variable_name,
+                                            param_dict, f, headers, cache_dir)
+            else:
+                data_to_add = read_file(source_name, variable_name, param_dict,
+                                        filepath, headers, cache_dir)
+        except Exception as e:
+            logger.info('error reading %s: %s', filepath, e)
+            errors.append((filepath, e))
+            continue
+        if data_to_add is not None:
+            results.append((seq, param_dict['resolution'], data_to_add))
+
+
+def download_and_read(sources_yaml_path, out_path, headers, start_date=None,
+                      end_date=None, subset=None, readers=2, queue_size=4,
+                      cache_dir=None, archive=None):
+    """
+    Download all files for each source and read each file as soon as it is
+    on disk, so that waiting for the network and parsing overlap. Returns a
+    dict of pandas.DataFrames, keyed by resolution, like ``read``.
+
+    Files are read by a pool of reader threads. The queue between the
+    downloader and the readers holds at most ``queue_size`` files; when it
+    is full, downloading pauses until a reader catches up.
+
+    Files that fail do not stop the others. Once all are done, a
+    RuntimeError listing the failed files is raised if there were any.
+
+    Parameters
+    ----------
+    sources_yaml_path : str
+        Filepath of sources.yml
+    out_path : str
+        Base download directory in which to save all downloaded files.
+    headers : list
+        List of strings indicating the level names of the pandas.MultiIndex
+        for the columns of the dataframe.
+    start_date : datetime.date, optional
+        Start of period for which to download the data.
+    end_date : datetime.date, optional
+        End of period for which to download the data
+    subset : list or iterable, optional
+        If given, specifies a subset of data sources to download,
+        e.g.: ['TenneT', '50Hertz'].
+    readers : int
+        Number of reader threads.
+    queue_size : int
+        Maximum number of downloaded files waiting to be read.
+    cache_dir : str, optional
+        Directory for Excel files converted to a fast binary format.
+        Defaults to ``.converted`` in out_path.
+    archive : archive.Archive, optional
+        Files already in this archive are read from it instead of being
+        downloaded again.
+
+    """
+    for name, date in {'end_date': end_date, 'start_date': start_date}.items():
+        if date and date > datetime.today().date():
+            logger.info('%s given was %s, must be smaller than %s, '
+                        'we have no data for the future!',
+                        name, date, datetime.today().date())
+            return
+
+    sources = load_sources(sources_yaml_path, subset)
+    if cache_dir is None:
+        cache_dir = os.path.join(out_path, '.converted')
+    # Keep the column IDs of earlier runs, see columns.py.
+    catalog.open(os.path.join(os.path.dirname(sources_yaml_path),
+                              CATALOG_FILE))
+
+    files = queue.Queue(maxsize=queue_size)
+    results = []
+    errors = []
+    started = time.time()
+
+    threads = [threading.Thread(
+        target=_downloader,
+        args=(sources, out_path, start_date, end_date, files, errors,
+              archive),
+        name='downloader'
+    )]
+    for i in range(readers):
+        threads.append(threading.Thread(
+            target=_reader,
+            args=(files, results, headers, cache_dir, errors, archive),
+            name='reader-{}'.format(i)
+        ))
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    # Do not go on with whole sources silently missing.
+    if errors:
+        raise RuntimeError(
+            '{} files could not be downloaded or read:\n{}'.format(
+                len(errors),
+                '\n'.join('{}: {!r}'.format(name, e) for name, e in errors))
+        ) from errors[0][1]
+
+    # Merge in download order, so overlapping data is resolved the same way
+    # on every run regardless of which reader finished first.
+    data_sets = {'15min': pd.DataFrame(), '60min': pd.DataFrame()}
+    for seq, resolution, data_to_add in sorted(results, key=lambda r: r[0]):
+        merge(data_sets, resolution, data_to_add)
+    fill_gaps(data_sets)
+    catalog.save()
+
+    logger.info('downloaded and read %s files in %.1f s',
+                len(results), time.time() - started)
+    return data_sets
@@ -0,0 +1,198 @@
+"""
+Open Power System Data
+
+Timeseries Datapackage
+
+profiling.py : opt-in profiles of downloading, reading and processing
+
+"""
+
+import atexit
+import cProfile
+import functools
+import io
+import logging
+import os
+import pstats
+import re
+import threading
+import time
+
+logger = logging.getLogger('log')
+logger.setLevel('INFO')
+
+# Set to a directory to profile a whole run, e.g. OPSD_PROFILE=profiles.
+ENV_VAR = 'OPSD_PROFILE'
+
+# Number of functions listed in the hotspot report.
+TOP_N = 30
+
+REPORT_FILE = 'report.txt'
+
+
+class Session(object):
+    """
+    Profiles collected since ``enable``, by stage and key, e.g.
+    ``('read', 'TenneT/wind/2015-01-01_2015-01-31/wind.csv')``.
+
+    """
+
+    def __init__(self, path, top=TOP_N):
+        self.path = path
+        self.top = top
+        self.stats = {}
+        self.timings = {}
+        self.lock = threading.Lock()
+
+    def add(self, stage, key, profile, seconds):
+        with self.lock:
+            calls, total = self.timings.get((stage, key), (0, 0.0))
+            self.timings[stage, key] = (calls + 1, total + seconds)
+            if profile is None:
+                return
+            if (stage, key) in self.stats:
+                self.stats[stage, key].add(profile)
+            else:
+                self.stats[stage, key] = pstats.Stats(profile)
+
+
+# The active Session, or None while profiling is off.
+_session = None
+
+# Whether the current thread is inside a profiled call already.
+_local = threading.local()
+
+
+def _filename(key):
+    return re.sub(r'[^\w.-]+', '_', key).strip('_') or 'all'
+
+
+def enable(path, top=TOP_N):
+    """
+    Start collecting profiles of all profiled functions. They are written to
+    path by ``report``, at the latest when the interpreter exits. Setting
+    the environment variable ``OPSD_PROFILE`` to path does the same.
+    Returns None.
+
+    Parameters
+    ----------
+    path : str
+        Directory to write the profiles and the report to.
+    top : int
+        Number of functions listed in the hotspot report.
+
+    """
+    global _session
+    os.makedirs(path, exist_ok=True)
+    _session = Session(path, top)
+    logger.info('profiling to %s', path)
+
+
+def disable():
+    """Stop profiling and write the report. Returns its path, or None."""
+    global _session
+    if _session is None:
+        return None
+    path = report()
+    _session = None
+    return path
+
+
+def profiled(stage, key=None):
+    """
+    Decorate a function to be profiled as a stage while profiling is
+    enabled. While it is off, the function is called directly.
+
+    Parameters
+    ----------
+    stage : str
+        Name of the stage, e.g. ``read``.
+    key : function, optional
+        Called with the arguments of the decorated function, returns the
+        name under which its profile is kept, e.g. the source and file.
+        Calls with the same key are added up.
+
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            session = _session
+            # Calls from within another profiled call are part of its
+            # profile already.
+            if session is None or getattr(_local, 'active', False):
+                return func(*args, **kwargs)
+
+            name = key(*args, **kwargs) if key else func.__name__
+            profile = cProfile.Profile()
+            try:
+                profile.enable()
+            except ValueError:
+                # Only one thread can profile at a time on Python 3.12+,
+                # keep just the timing of this call.
+                profile = None
+            _local.active = True
+            started = time.time()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                seconds = time.time() - started
+                _local.active = False
+                if profile is not None:
+                    profile.disable()
+                session.add(stage, name, profile, seconds)
+        return wrapper
+    return decorator
+
+
+def report(top=None):
+    """
+    Write the profile of each stage and key as a ``.prof`` file, which can
+    be opened with pstats or snakeviz, and a report with the time taken per
+    stage and key and the top functions over all profiles. Returns the path
+    of the report.
+
+    """
+    session = _session
+    if session is None:
+        return None
+    top = top or session.top
+
+    with session.lock:
+        stats = dict(session.stats)
+        timings = dict(session.timings)
+
+    for (stage, name), stage_stats in stats.items():
+        stage_dir = os.path.join(session.path, stage)
+        os.makedirs(stage_dir, exist_ok=True)
+        stage_stats.dump_stats(
+            os.path.join(stage_dir, _filename(name) + '.prof'))
+
+    stream = io.StringIO()
+    stream.write('{:<12} {:>8} {:>10}  {}\n'.format(
+        'stage', 'calls', 'seconds', 'key'))
+    for (stage, name), (calls, seconds) in sorted(
+            timings.items(), key=lambda t: -t[1][1]):
+        stream.write('{:<12} {:>8} {:>10.2f}  {}\n'.format(
+            stage, calls, seconds, name))
+
+    if stats:
+        total = pstats.Stats(stream=stream)
+        for stage_stats in stats.values():
+            total.add(stage_stats)
+        stream.write('\ntop {} functions over all profiles\n'.format(top))
+        total.sort_stats('cumulative').print_stats(top)
+        stream.write('\n')
+        total.sort_stats('tottime').print_stats(top)
+
+    path = os.path.join(session.path, REPORT_FILE)
+    with open(path, 'w') as f:
+        f.write(stream.getvalue())
+    logger.info('profiling report written to %s', path)
+    return path
+
+
+if os.environ.get(ENV_VAR):
+    enable(os.environ[ENV_VAR])
+
+# Write the report of a run that was not disabled explicitly.
+atexit.register(disable)
@@ -9,12 +9,18 @@ read.py : read time series files
 
 from datetime import datetime, date, timedelta
 import pytz
-import yaml
 import os
 import numpy as np
 import pandas as pd
 import logging
 
+from .bulk import read_csv_bulk
+from .columns import CATALOG_FILE, catalog
+from .convert import converted
+from .download import load_sources
+from .fingerprint import LAYOUTS, identify, layouts
+from .profiling import profiled
+
 logger = logging.getLogger('log')
 logger.setLevel('INFO')
 
@@ -58,8 +64,7 @@ def read_elia(filepath, variable_name, web, headers):
         for attribute
         in df.columns
     ]
-    columns = pd.MultiIndex.from_tuples(tuples, names=headers)
-    df.columns = columns
+    df = catalog.label(df, tuples, headers)
     
     return df
 
@@ -132,12 +137,12 @@ def read_energinet_dk(filepath, web, headers):
         'DK: Wind power production (offshore)': ('wind', 'DK', 'offshore', source, web)
     }
 
-    tuples = [colmap[col] if col in colmap else (col, '', 'x', source, web) for col in df.columns]
+    # Drop the columns we have no mapping for.
+    df = df.loc[:, [col in colmap for col in df.columns]]
+    tuples = [colmap[col] for col in df.columns]
     
     # Create the MultiIndex.  
-    columns = pd.MultiIndex.from_tuples(tuples, names=headers)
-    df.columns = columns
-    df.drop(['x'], axis=1, level=2, inplace=True)
+    df = catalog.label(df, tuples, headers)
         
     return df
 
@@ -210,13 +215,24 @@ def read_entso(filepath, web, headers):
     
     # Create the MultiIndex.  
     tuples = [('load', country, 'load', 'ENTSO-E', web) for country in df.columns]
-    columns = pd.MultiIndex.from_tuples(tuples, names=headers)
-    df.columns = columns
+    df = catalog.label(df, tuples, headers)
     
     return df
 
 
-def read_hertz(filepath, tech_attribute, web, headers):
+def _hertz_ambiguous(index):
+    # Until 2006 as well as  in 2015, during the fall dst-transistion, only the
+    # wintertime hour (marked by a B in the data) is reported, the summertime
+    # hour, (marked by an A) is missing in the data.
+    # dst_arr is a boolean array consisting only of "False" entries, telling
+    # python to treat the hour from 2:00 to 2:59 as wintertime.
+    if pd.to_datetime(index.values[0]).year not in range(2007,2015):
+        dst_arr = np.zeros(len(index), dtype=bool)
+        return dst_arr
+    return 'infer'
+
+
+def read_hertz(filepath, tech_attribute, web, headers, layout=None):
     """
     Read a .csv file with wind or solar power timeseries data from 
     50Hertz into a dataframe. Returns a pandas.DataFrame.
@@ -232,49 +248,74 @@ def read_hertz(filepath, tech_attribute, web, headers):
     headers : list
         List of strings indicating the level names of the pandas.MultiIndex
         for the columns of the dataframe.
+    layout : fingerprint.Layout, optional
+        Layout of the file as found by ``identify``. Defaults to the first
+        one registered for the source.
 
     """
+    if layout is None:
+        layout = layouts('50Hertz', tech_attribute)[0]
     tech = tech_attribute.split('_')[0]
     attribute = tech_attribute.split('_')[1]
-    df = pd.read_csv(
-        filepath,
-        sep=';',
-        header=3,
-        index_col='timestamp',
-        names=['date',
-               'time',
-               attribute],
-        parse_dates={'timestamp': ['date', 'time']},
-        date_parser=None,
-        dayfirst=True,
-        decimal=',',
-        thousands='.',
-        # truncate values in 'time' column after 5th character
-        converters={'time': lambda x: x[:5]},
-        usecols=[0, 1, 3],
-    )
-    
-    # Until 2006 as well as  in 2015, during the fall dst-transistion, only the 
-    # wintertime hour (marked by a B in the data) is reported, the summertime 
-    # hour, (marked by an A) is missing in the data.  
-    # dst_arr is a boolean array consisting only of "False" entries, telling 
-    # python to treat the hour from 2:00 to 2:59 as wintertime.
-    if pd.to_datetime(df.index.values[0]).year not in range(2007,2015):
-        dst_arr = np.zeros(len(df.index), dtype=bool)
-        df.index = df.index.tz_localize('Europe/Berlin', ambiguous=dst_arr)
-    else:
-        df.index = df.index.tz_localize('Europe/Berlin', ambiguous='infer')
-    df.index = df.index.tz_convert(None)
+    try:
+        # The yearly files are large, so decode them straight from the raw
+        # bytes, including the conversion to UTC, and only use the full
+        # parser if the layout is unexpected.
+        df = read_csv_bulk(
+            filepath,
+            sep=layout.sep,
+            skiprows=layout.skiprows,
+            date_col=0,
+            date_format='%d.%m.%Y',
+            time_col=1,
+            time_format='%H:%M',
+            value_cols=[(attribute, 3)],
+            decimal=',',
+            thousands='.',
+            tz='Europe/Berlin',
+            ambiguous=_hertz_ambiguous,
+        )
+    except ValueError as e:
+        logger.info('bulk decoding failed, using pandas parser: %s', e)
+        df = pd.read_csv(
+            filepath,
+            sep=layout.sep,
+            header=layout.skiprows - 1,
+            index_col='timestamp',
+            names=['date',
+                   'time',
+                   attribute],
+            parse_dates={'timestamp': ['date', 'time']},
+            date_parser=None,
+            dayfirst=True,
+            decimal=',',
+            thousands='.',
+            # truncate values in 'time' column after 5th character
+            converters={'time': lambda x: x[:5]},
+            usecols=[0, 1, 3],
+        )
+        df.index = df.index.tz_localize('Europe/Berlin',
+                                        ambiguous=_hertz_ambiguous(df.index))
+        df.index = df.index.tz_convert(None)
     
     # Create the MultiIndex
     tuples = [(tech, 'DE50hertz', attribute, '50Hertz', web)]
-    columns = pd.MultiIndex.from_tuples(tuples, names=headers)
-    df.columns = columns
+    df = catalog.label(df, tuples, headers)
     
     return df
 
 
-def read_amprion(filepath, variable_name, web, headers):
+def _amprion_ambiguous(index):
+    # Only the summertime hour of the fall dst-transition is reported after
+    # 2009, see the pandas fallback in read_amprion.
+    if (index.year <= 2009).all():
+        return 'infer'
+    if (index.year > 2009).all():
+        return True
+    raise ValueError('data before and after 2010 is localized in two parts')
+
+
+def read_amprion(filepath, variable_name, web, headers, layout=None):
     """
     Read a .csv file with wind or solar power timeseries data from 
     Amprion into a dataframe. Returns a pandas.DataFrame.
@@ -290,39 +331,58 @@ def read_amprion(filepath, variable_name, web, headers):
     headers : list
         List of strings indicating the level names of the pandas.MultiIndex
         for the columns of the dataframe.
+    layout : fingerprint.Layout, optional
+        Layout of the file as found by ``identify``. Defaults to the first
+        one registered for the source.
 
     """
-    df = pd.read_csv(
-        filepath,
-        sep=';',
-        header=0,
-        index_col='timestamp',
-        names=['date',
-               'time',
-               'forecast',
-               'generation'],
-        parse_dates={'timestamp' : ['date', 'time']},
-        date_parser=None,
-        dayfirst=True,
-        decimal=',',
-        thousands=None,
-        # Truncate values in 'time' column after 5th character.
-        converters={'time': lambda x: x[:5]},
-        usecols=[0, 1, 2, 3],        
-    )
-
-    index1 = df.index[df.index.year <= 2009]
-    index1 = index1.tz_localize('Europe/Berlin', ambiguous='infer')
-    
-    # In the years after 2009, during the fall dst-transistion, only the
-    # summertime hour is reported, the wintertime hour is missing in the data.  
-    # dst_arr is a boolean array consisting only of "True" entries, telling 
-    # python to treat the hour from 2:00 to 2:59 as summertime.
-    index2 = df.index[df.index.year > 2009]
-    dst_arr = np.ones(len(index2), dtype=bool)
-    index2 = index2.tz_localize('Europe/Berlin', ambiguous=dst_arr)        
-    df.index = index1.append(index2)
-    df.index = df.index.tz_convert(None)
+    if layout is None:
+        layout = layouts('Amprion', variable_name)[0]
+    try:
+        df = read_csv_bulk(
+            filepath,
+            sep=layout.sep,
+            skiprows=layout.skiprows,
+            date_col=0,
+            date_format='%d.%m.%Y',
+            time_col=1,
+            time_format='%H:%M',
+            value_cols=[('forecast', 2), ('generation', 3)],
+            decimal=',',
+            tz='Europe/Berlin',
+            ambiguous=_amprion_ambiguous,
+        )
+    except ValueError as e:
+        logger.info('bulk decoding failed, using pandas parser: %s', e)
+        df = pd.read_csv(
+            filepath,
+            sep=layout.sep,
+            header=layout.skiprows - 1,
+            index_col='timestamp',
+            names=['date',
+                   'time',
+                   'forecast',
+                   'generation'],
+            parse_dates={'timestamp' : ['date', 'time']},
+            date_parser=None,
+            dayfirst=True,
+            decimal=',',
+            thousands=None,
+            # Truncate values in 'time' column after 5th character.
+            converters={'time': lambda x: x[:5]},
+            usecols=[0, 1, 2, 3],        
+        )
+        index1 = df.index[df.index.year <= 2009]
+        index1 = index1.tz_localize('Europe/Berlin', ambiguous='infer')
+        # In the years after 2009, during the fall dst-transistion, only the
+        # summertime hour is reported, the wintertime hour is missing in the data.  
+        # dst_arr is a boolean array consisting only of "True" entries, telling 
+        # python to treat the hour from 2:00 to 2:59 as summertime.
+        index2 = df.index[df.index.year > 2009]
+        dst_arr = np.ones(len(index2), dtype=bool)
+        index2 = index2.tz_localize('Europe/Berlin', ambiguous=dst_arr)        
+        df.index = index1.append(index2)
+        df.index = df.index.tz_convert(None)
     
     # Create the MultiIndex
     tuples = [
@@ -330,13 +390,12 @@ def read_amprion(filepath, variable_name, web, headers):
         for attribute
         in df.columns
     ]
-    columns = pd.MultiIndex.from_tuples(tuples, names=headers)
-    df.columns = columns    
+    df = catalog.label(df, tuples, headers)
 
     return df
 
 
-def read_tennet(filepath, variable_name, web, headers):
+def read_tennet(filepath, variable_name, web, headers, layout=None):
     """
     Read a .csv file with wind or solar power timeseries data from 
     TenneT DE into a dataframe. Returns a pandas.DataFrame.
@@ -352,20 +411,23 @@ def read_tennet(filepath, variable_name, web, headers):
     headers : list
         List of strings indicating the level names of the pandas.MultiIndex
         for the columns of the dataframe.
+    layout : fingerprint.Layout, optional
+        Layout of the file as found by ``identify``. Defaults to the first
+        one registered for the source.
 
     """
-    if variable_name == 'solar':
-        cols = [0, 1, 2, 3]
-        colnames = ['date', 'pos', 'forecast', 'generation']
-    if variable_name == 'wind':
-        cols = [0, 1, 2, 3, 4]
-        colnames = ['date', 'pos', 'forecast', 'generation', 'offshore']
+    if layout is None:
+        layout = layouts('TenneT', variable_name)[0]
+    # The wind files have an extra column with the offshore generation.
+    colnames = ['date', 'pos', 'forecast', 'generation', 'offshore']
+    colnames = colnames[:len(layout.header)]
+    cols = list(range(len(colnames)))
         
     df = pd.read_csv(
         filepath,
-        sep=';',
+        sep=layout.sep,
         encoding='latin_1',
-        header=3,
+        header=layout.skiprows - 1,
         index_col=None,
         names=colnames,
         parse_dates=False,
@@ -447,16 +509,15 @@ def read_tennet(filepath, variable_name, web, headers):
         for attribute
         in df.columns[0:1]
     ]
-    if variable_name == 'wind': # offshore data becomes available 2009-09-20
+    if 'offshore' in df.columns: # offshore data becomes available 2009-09-20
         tuples.append(('wind-offshore', 'DEtennet', 'generation', 'TenneT', web))
         
-    columns = pd.MultiIndex.from_tuples(tuples, names=headers)
-    df.columns = columns
+    df = catalog.label(df, tuples, headers)
     
     return df
 
 
-def read_transnetbw(filepath, variable_name, web, headers):
+def read_transnetbw(filepath, variable_name, web, headers, layout=None):
     """
     Read a .csv file with wind or solar power timeseries data from 
     TransnetBW into a dataframe. Returns a pandas.DataFrame.
@@ -472,12 +533,17 @@ def read_transnetbw(filepath, variable_name, web, headers):
     headers : list
         List of strings indicating the level names of the pandas.MultiIndex
         for the columns of the dataframe.
+    layout : fingerprint.Layout, optional
+        Layout of the file as found by ``identify``. Defaults to the first
+        one registered for the source.
 
     """
+    if layout is None:
+        layout = layouts('TransnetBW', variable_name)[0]
     df = pd.read_csv(
         filepath,
-        sep=';',
-        header=0,
+        sep=layout.sep,
+        header=layout.skiprows - 1,
         index_col='timestamp',
         names=['date',
                'time',
@@ -508,13 +574,12 @@ def read_transnetbw(filepath, variable_name, web, headers):
         for attribute
         in df.columns
     ]
-    columns = pd.MultiIndex.from_tuples(tuples, names=headers)
-    df.columns = columns
+    df = catalog.label(df, tuples, headers)
     
     return df
 
 
-def read_capacities(filepath, web, headers):
+def read_capacities(filepath, web, headers, layout=None):
     """
     Read a .csv file with capacity timeseries data from the OPSD renewables
     datapacke into a dataframe. Returns a pandas.DataFrame.
@@ -528,24 +593,41 @@ def read_capacities(filepath, web, headers):
     headers : list
         List of strings indicating the level names of the pandas.MultiIndex
         for the columns of the dataframe.
+    layout : fingerprint.Layout, optional
+        Layout of the file as found by ``identify``. Defaults to the first
+        one registered for the source.
 
     """
-    df = pd.read_csv(
-        filepath,
-        sep=',',
-        header=0,
-        index_col='timestamp',
-        names=['timestamp',
-               'wind',
-               'solar'],
-        parse_dates=True,
-        date_parser=None,         
-        dayfirst=True,
-        decimal='.',
-        thousands=None,
-        converters=None,
-        usecols=[0,2,3],
-    )
+    if layout is None:
+        layout = layouts('OPSD', None)[0]
+    try:
+        df = read_csv_bulk(
+            filepath,
+            sep=layout.sep,
+            skiprows=layout.skiprows,
+            date_col=0,
+            date_format='%Y-%m-%d',
+            value_cols=[('wind', 2), ('solar', 3)],
+            decimal='.',
+        )
+    except ValueError as e:
+        logger.info('bulk decoding failed, using pandas parser: %s', e)
+        df = pd.read_csv(
+            filepath,
+            sep=layout.sep,
+            header=layout.skiprows - 1,
+            index_col='timestamp',
+            names=['timestamp',
+                   'wind',
+                   'solar'],
+            parse_dates=True,
+            date_parser=None,         
+            dayfirst=True,
+            decimal='.',
+            thousands=None,
+            converters=None,
+            usecols=[0,2,3],
+        )
     
     # The capacities data only has one entry per day, which pandas 
     # interprets as 00:00h. We will broadcast the dayly data for 
@@ -565,8 +647,7 @@ def read_capacities(filepath, web, headers):
         for tech
         in df.columns
     ]
-    columns = pd.MultiIndex.from_tuples(tuples, names=headers)
-    df.columns = columns
+    df = catalog.label(df, tuples, headers)
     
     return df
 
@@ -640,16 +721,151 @@ def read_svenska_kraftnaet(filePath, variable_name, web, headers):
         for tech
         in df.columns
     ]
-    columns = pd.MultiIndex.from_tuples(tuples, names=headers)
-    df.columns = columns
+    df = catalog.label(df, tuples, headers)
     
     return df
 
 
-def read(sources_yaml_path, out_path, headers, subset=None):
+def _file_key(source_name, variable_name, param_dict, filepath, *args):
+    # Filenames repeat across periods, so the container is part of the key.
+    filename = getattr(filepath, 'name', filepath)
+    container = getattr(filepath, 'container', None) or \
+        os.path.basename(os.path.dirname(filename))
+    return '/'.join([source_name, variable_name, container,
+                     os.path.basename(filename)])
+
+
+@profiled('read', key=_file_key)
+def read_file(source_name, variable_name, param_dict, filepath, headers,
+              cache_dir=None):
     """
-    Read a .xls file with hourly load data from the Energinet DK Data Portal
-    into a dataframe. Returns a pandas.DataFrame.
+    Read a single downloaded file with the read function for its source.
+    Returns a pandas.DataFrame, or None if the file is probably empty.
+    Raises ValueError if the file does not match any known layout of its
+    source, see fingerprint.py.
+
+    Parameters
+    ----------
+    source_name : str
+        Name of source dataset, e.g. ``TenneT``
+    variable_name : str
+        Name of variable, e.g. ``solar``
+    param_dict : dict
+        Parameters of the variable from sources.yml
+    filepath : str or archive.ArchiveFile
+        Directory path of file to be read, or a file opened from the archive.
+    headers : list
+        List of strings indicating the level names of the pandas.MultiIndex
+        for the columns of the dataframe.
+    cache_dir : str, optional
+        Directory in which Excel files are kept converted to a fast binary
+        format after they have been read once, see convert.py.
+
+    """
+    if hasattr(filepath, 'read'):
+        filename, size = filepath.name, filepath.size
+    else:
+        filename, size = os.path.basename(filepath), os.path.getsize(filepath)
+    logger.info(
+        'reading data:\n         '
+        'Source:   %s\n         '
+        'Variable: %s\n         '
+        'Filename: %s',
+        source_name, variable_name, filename
+    )
+    # Check if file is not empty
+    if size < 128:
+        logger.info(
+            'file is smaller than 128 Byte, which means it is probably empty'
+        )
+        return None
+
+    # Reject files whose format has changed before spending time on parsing,
+    # and parse the others the way the layout they match says.
+    layout = None
+    if source_name in LAYOUTS:
+        layout = identify(source_name, variable_name, filepath)
+        if layout is None:
+            # A changed format must not drop the source from the data.
+            raise ValueError('unknown layout of {} {} file {}'.format(
+                source_name, variable_name, filename))
+
+    data_to_add = None
+    if source_name == 'ENTSO-E':
+        data_to_add = converted(read_entso, filepath, param_dict['web'], headers,
+                                cache_dir=cache_dir)
+    if source_name == 'Energinet.dk':
+        data_to_add = converted(read_energinet_dk, filepath, param_dict['web'],
+                                headers, cache_dir=cache_dir)
+    elif source_name == 'Svenska Kraftnaet':
+        data_to_add = converted(read_svenska_kraftnaet, filepath, variable_name,
+                                param_dict['web'], headers, cache_dir=cache_dir)
+    elif source_name == '50Hertz':
+        data_to_add = read_hertz(filepath, variable_name, param_dict['web'],
+                                 headers, layout=layout)
+    elif source_name == 'Amprion':
+        data_to_add = read_amprion(filepath, variable_name, param_dict['web'],
+                                   headers, layout=layout)
+    elif source_name == 'TenneT':
+        data_to_add = read_tennet(filepath, variable_name, param_dict['web'],
+                                  headers, layout=layout)
+    elif source_name == 'TransnetBW':
+        data_to_add = read_transnetbw(filepath, variable_name,
+                                      param_dict['web'], headers,
+                                      layout=layout)
+    elif source_name == 'OPSD':
+        data_to_add = read_capacities(filepath, param_dict['web'], headers,
+                                      layout=layout)
+    elif source_name == 'Elia':
+        data_to_add = converted(read_elia, filepath, variable_name,
+                                param_dict['web'], headers, cache_dir=cache_dir)
+
+    # cut off data_to_add at end of year:
+        data_to_add = data_to_add[:'2015-12-31 22:45:00']
+
+    return data_to_add
+
+
+@profiled('merge', key=lambda data_sets, resolution, data_to_add: resolution)
+def merge(data_sets, resolution, data_to_add):
+    """
+    Add data_to_add to the dataset for its resolution in data_sets,
+    keeping existing values where both overlap. Returns None.
+
+    """
+    if len(data_sets[resolution]) == 0:
+        data_sets[resolution] = data_to_add
+    else:
+        data_sets[resolution] = \
+        data_sets[resolution].combine_first(data_to_add)
+
+
+@profiled('fill_gaps')
+def fill_gaps(data_sets):
+    """
+    Reindex each non-empty dataset in data_sets with a continuous index, so
+    that gaps in the data show up as NaN, and bring its columns into
+    canonical order. Returns None.
+
+    """
+    for res_key, df in data_sets.items():
+        if len(df) > 0:
+            #reindex with a synthetic index that is sure to be continous in order to expose gaps in the data
+            no_gaps = pd.date_range(start=df.index[0], end=df.index[-1],
+                                    freq=res_key)
+            df = df.reindex(index=no_gaps)
+
+        # Keep the columns in canonical order so later merges and slices stay on
+        # the fast path for lexsorted MultiIndexes.
+        data_sets[res_key] = catalog.sort_columns(df)
+
+
+def read(sources_yaml_path, out_path, headers, subset=None, archive=None,
+         cache_dir=None):
+    """
+    Read all downloaded files for the sources in sources.yml and merge them
+    into one dataframe per time resolution. Returns a dict of
+    pandas.DataFrames, keyed by resolution.
 
     Parameters
     ----------
@@ -663,80 +879,64 @@ def read(sources_yaml_path, out_path, headers, subset=None):
     subset : list or iterable, optional
         If given, specifies a subset of data sources to download,
         e.g.: ['TenneT', '50Hertz'].
+    archive : archive.Archive, optional
+        If given, the files in this archive are read from it. Files in
+        out_path are read, too, unless their container is archived, e.g.
+        new periods downloaded after ``archive_tree``.
+    cache_dir : str, optional
+        Directory for Excel files converted to a fast binary format.
+        Defaults to ``.converted`` in out_path.
         
     """
     data_sets = {'15min': pd.DataFrame(), '60min': pd.DataFrame()}
+    if cache_dir is None:
+        cache_dir = os.path.join(out_path, '.converted')
+    # Keep the column IDs of earlier runs, see columns.py.
+    catalog.open(os.path.join(os.path.dirname(sources_yaml_path),
+                              CATALOG_FILE))
 
-    with open(sources_yaml_path, 'r') as f:
-        sources = yaml.load(f.read())
-
-    # If subset is given, only keep source_name keys in subset
-    if subset is not None:
-        sources = {k: v for k, v in sources.items() if k in subset}
+    sources = load_sources(sources_yaml_path, subset)
     
     # For each source in the source dictionary
     for source_name, source_dict in sources.items():
         # For each variable from source_name
         for variable_name, param_dict in source_dict.items():
+            archived = set()
+            if archive is not None:
+                archived = set(archive.containers(source_name, variable_name))
+                for container in sorted(archived):
+                    with archive.open(source_name, variable_name, container) as f:
+                        data_to_add = read_file(source_name, variable_name,
+                                                param_dict, f, headers,
+                                                cache_dir)
+                    if data_to_add is not None:
+                        merge(data_sets, param_dict['resolution'], data_to_add)
+
             variable_dir = os.path.join(out_path, source_name, variable_name)
             # Check if there are folders for variable_name
             if not os.path.exists(variable_dir):
-                logger.info('folder not found for %s, %s', source_name, variable_name)
+                if not archived:
+                    logger.info('folder not found for %s, %s', source_name, variable_name)
             else:
-                # For each file downloaded for that variable
+                # For each file downloaded for that variable and not read
+                # from the archive already
                 for container in os.listdir(variable_dir):
+                    if container in archived:
+                        continue
                     files = os.listdir(os.path.join(variable_dir, container))
                     # Check if there is only one file per folder
                     if not len(files) == 1:
                         logger.info('error: found more than one file in %s %s %s',
                                     source_name, variable_name, container)
                     else:                        
-                        logger.info(
-                            'reading data:\n         '
-                            'Source:   %s\n         '
-                            'Variable: %s\n         '
-                            'Filename: %s',
-                            source_name, variable_name, files[0]
-                        )
                         filepath = os.path.join(variable_dir, container, files[0])
-                        # Check if file is not empty
-                        if os.path.getsize(filepath) < 128:
-                            logger.info(
-                                'file is smaller than 128 Byte, which means it is probably empty'
-                            )
-                        else:
-                            if source_name == 'ENTSO-E':
-                                data_to_add = read_entso(filepath, param_dict['web'], headers)
-                            if source_name == 'Energinet.dk':
-                                data_to_add = read_energinet_dk(filepath, param_dict['web'], headers)
-                            elif source_name == 'Svenska Kraftnaet':
-                                data_to_add = read_svenska_kraftnaet(filepath, variable_name, param_dict['web'], headers)
-                            elif source_name == '50Hertz':
-                                data_to_add = read_hertz(filepath, variable_name, param_dict['web'], headers)
-                            elif source_name == 'Amprion':
-                                data_to_add = read_amprion(filepath, variable_name, param_dict['web'], headers)
-                            elif source_name == 'TenneT':
-                                data_to_add = read_tennet(filepath, variable_name, param_dict['web'], headers)
-                            elif source_name == 'TransnetBW':
-                                data_to_add = read_transnetbw(filepath, variable_name, param_dict['web'], headers)
-                            elif source_name == 'OPSD':
-                                data_to_add = read_capacities(filepath, param_dict['web'], headers)
-                            elif source_name == 'Elia':
-                                data_to_add = read_elia(filepath, variable_name, param_dict['web'], headers)
-
-                            # cut off data_to_add at end of year:
-                                data_to_add = data_to_add[:'2015-12-31 22:45:00']
-
-                            if len(data_sets[param_dict['resolution']]) == 0:
-                                data_sets[param_dict['resolution']] = data_to_add
-                            else:
-                                data_sets[param_dict['resolution']] = \
-                                data_sets[param_dict['resolution']].combine_first(data_to_add)
-            
-            #reindex with a synthetic index that is sure to be continous in order to expose gaps in the data
-            no_gaps = pd.DatetimeIndex(start=data_sets[param_dict['resolution']].index[0],
-                                       end=data_sets[param_dict['resolution']].index[-1],
-                                       freq=param_dict['resolution'])
-            data_sets[param_dict['resolution']] = data_sets[param_dict['resolution']].reindex(index=no_gaps)
+                        data_to_add = read_file(source_name, variable_name,
+                                                param_dict, filepath, headers,
+                                                cache_dir)
+                        if data_to_add is not None:
+                            merge(data_sets, param_dict['resolution'], data_to_add)
+
+    fill_gaps(data_sets)
+    catalog.save()
             
-    return data_sets
\ No newline at end of file
+    return data_sets
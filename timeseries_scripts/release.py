@@ -0,0 +1,254 @@
+"""
+Open Power System Data
+
+Timeseries Datapackage
+
+release.py : versioned releases that only store the data changed since the
+last one
+
+"""
+
+import gzip
+import hashlib
+import json
+import logging
+import os
+
+import numpy as np
+import pandas as pd
+
+from .export import export
+
+logger = logging.getLogger('log')
+logger.setLevel('INFO')
+
+OBJECTS_DIR = 'objects'
+VERSIONS_DIR = 'versions'
+
+
+def chunk_bounds(index):
+    """
+    Split a sorted DatetimeIndex into calendar years. Returns a list of
+    (year, first row, end row) tuples.
+
+    """
+    if len(index) == 0:
+        return []
+    years = np.asarray(index.year)
+    starts = np.concatenate([[0], np.flatnonzero(np.diff(years)) + 1])
+    ends = np.concatenate([starts[1:], [len(years)]])
+    return [(int(years[s]), int(s), int(e)) for s, e in zip(starts, ends)]
+
+
+class ReleaseStore(object):
+    """
+    Store of released versions of the data sets. Each resolution is split
+    into one chunk per column and calendar year, and each chunk is stored
+    compressed under the sha256 of its content, so a new version only adds
+    the chunks that changed. A manifest per version lists the hashes of its
+    chunks, from which the version is rebuilt or compared to another.
+
+    Parameters
+    ----------
+    path : str
+        Directory of the store. Created if it does not exist.
+
+    """
+
+    def __init__(self, path):
+        self.path = path
+        os.makedirs(os.path.join(path, OBJECTS_DIR), exist_ok=True)
+        os.makedirs(os.path.join(path, VERSIONS_DIR), exist_ok=True)
+
+    def _object_path(self, checksum):
+        return os.path.join(self.path, OBJECTS_DIR, checksum[:2],
+                            checksum + '.gz')
+
+    def _manifest_path(self, version):
+        return os.path.join(self.path, VERSIONS_DIR, version + '.json')
+
+    def _put(self, array):
+        """
+        Store a 1d array unless its content is stored already.
+        Returns (sha256, number of bytes written).
+
+        """
+        data = np.ascontiguousarray(array).tobytes()
+        checksum = hashlib.sha256(array.dtype.str.encode() + data).hexdigest()
+        object_path = self._object_path(checksum)
+        if os.path.exists(object_path):
+            return checksum, 0
+        os.makedirs(os.path.dirname(object_path), exist_ok=True)
+        tmp_path = object_path + '.tmp'
+        with gzip.open(tmp_path, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, object_path)
+        return checksum, os.path.getsize(object_path)
+
+    def _get(self, checksum, dtype):
+        with gzip.open(self._object_path(checksum), 'rb') as f:
+            return np.frombuffer(f.read(), dtype=dtype)
+
+    def versions(self):
+        """Return the sorted list of stored versions."""
+        return sorted(name[:-len('.json')] for name in
+                      os.listdir(os.path.join(self.path, VERSIONS_DIR))
+                      if name.endswith('.json'))
+
+    def manifest(self, version):
+        """Return the manifest of a version as a dict."""
+        with open(self._manifest_path(version), 'r') as f:
+            return json.load(f)
+
+    def add(self, version, data_sets, replace=False):
+        """
+        Store data_sets as a new version. Returns a dict with the number of
+        chunks of the version, the number of them that were new and the
+        compressed bytes written.
+
+        Parameters
+        ----------
+        version : str
+            Name of the version, e.g. ``2016-07-14``.
+        data_sets : dict
+            Maps resolutions, e.g. ``15min``, to the pandas.DataFrame.
+        replace : bool
+            If True, a stored version of the same name is replaced, e.g.
+            when a release is rebuilt. Otherwise this raises ValueError.
+
+        """
+        if os.path.exists(self._manifest_path(version)) and not replace:
+            raise ValueError('version exists already: {}'.format(version))
+
+        stats = {'chunks': 0, 'new_chunks': 0, 'bytes': 0}
+        manifest = {}
+        for res_key, df in data_sets.items():
+            if df.empty:
+                continue
+            index = df.index.values.astype('datetime64[ns]').astype(np.int64)
+            values = np.asfortranarray(df.values, dtype=np.float64)
+            chunks = {}
+            for year, first, end in chunk_bounds(df.index):
+                hashes = []
+                for array in [index[first:end]] + \
+                        [values[first:end, i] for i in range(values.shape[1])]:
+                    checksum, written = self._put(array)
+                    hashes.append(checksum)
+                    stats['chunks'] += 1
+                    stats['new_chunks'] += written > 0
+                    stats['bytes'] += written
+                chunks[str(year)] = {'index': hashes[0], 'values': hashes[1:]}
+            manifest[res_key] = {
+                'names': list(df.columns.names),
+                'columns': [list(col) for col in df.columns],
+                'chunks': chunks,
+            }
+
+        # Written last, so that a version is only listed once complete.
+        tmp_path = self._manifest_path(version) + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(manifest, f, indent=1, sort_keys=True)
+        os.replace(tmp_path, self._manifest_path(version))
+
+        logger.info('stored version %s: %s of %s chunks new, %s bytes',
+                    version, stats['new_chunks'], stats['chunks'],
+                    stats['bytes'])
+        return stats
+
+    def load(self, version, res_key, columns=None, years=None):
+        """
+        Rebuild the data set of one resolution of a version, reading only
+        the chunks asked for. Returns a pandas.DataFrame.
+
+        Parameters
+        ----------
+        version : str
+            Name of the version.
+        res_key : str
+            Resolution, e.g. ``15min``.
+        columns : list, optional
+            Column tuples to load. Defaults to all.
+        years : list, optional
+            Calendar years to load. Defaults to all.
+
+        """
+        entry = self.manifest(version)[res_key]
+        tuples = [tuple(col) for col in entry['columns']]
+        positions = range(len(tuples)) if columns is None else \
+            [tuples.index(tuple(col)) for col in columns]
+        chunks = sorted(entry['chunks'].items(), key=lambda c: int(c[0]))
+        if years is not None:
+            chunks = [c for c in chunks if int(c[0]) in years]
+
+        frames = []
+        for year, chunk in chunks:
+            index = self._get(chunk['index'], np.int64)
+            values = np.empty((len(index), len(positions)))
+            for i, pos in enumerate(positions):
+                values[:, i] = self._get(chunk['values'][pos], np.float64)
+            frames.append(pd.DataFrame(
+                values, index=pd.DatetimeIndex(index.astype('datetime64[ns]'),
+                                               name='timestamp')))
+        if not frames:
+            # No chunk in the years asked for, keep the columns anyway.
+            frames.append(pd.DataFrame(
+                np.empty((0, len(positions))),
+                index=pd.DatetimeIndex([], dtype='datetime64[ns]',
+                                       name='timestamp')))
+        df = pd.concat(frames)
+        df.columns = pd.MultiIndex.from_tuples(
+            [tuples[pos] for pos in positions], names=entry['names'])
+        return df
+
+    def checkout(self, version, out_path, formats=None):
+        """
+        Write the output files of a version to out_path, as ``export``
+        does. Returns the timings returned by ``export``.
+
+        """
+        data_sets = {res_key: self.load(version, res_key)
+                     for res_key in self.manifest(version)}
+        return export(data_sets, out_path, formats)
+
+    def diff(self, old, new):
+        """
+        Compare two versions by their manifests, without reading any data.
+        Returns a dict by resolution of dicts with the columns ``added`` and
+        ``removed``, and for each ``changed`` column the years in which its
+        values or timestamps differ.
+
+        """
+        old_manifest, new_manifest = self.manifest(old), self.manifest(new)
+        result = {}
+        for res_key in sorted(set(old_manifest) | set(new_manifest)):
+            empty = {'columns': [], 'chunks': {}}
+            a = old_manifest.get(res_key, empty)
+            b = new_manifest.get(res_key, empty)
+            a_columns = [tuple(col) for col in a['columns']]
+            b_columns = [tuple(col) for col in b['columns']]
+            a_pos = {col: pos for pos, col in enumerate(a_columns)}
+            b_set = set(b_columns)
+
+            changed = {}
+            for b_col_pos, col in enumerate(b_columns):
+                if col not in a_pos:
+                    continue
+                years = []
+                for year in sorted(set(a['chunks']) | set(b['chunks']),
+                                   key=int):
+                    a_chunk = a['chunks'].get(year)
+                    b_chunk = b['chunks'].get(year)
+                    if a_chunk is None or b_chunk is None \
+                            or a_chunk['index'] != b_chunk['index'] \
+                            or a_chunk['values'][a_pos[col]] != \
+                            b_chunk['values'][b_col_pos]:
+                        years.append(int(year))
+                if years:
+                    changed[col] = years
+
+            result[res_key] = {
+                'added': [col for col in b_columns if col not in a_pos],
+                'removed': [col for col in a_columns if col not in b_set],
+                'changed': changed,
+            }
+        return result
@@ -0,0 +1,376 @@
+"""
+Open Power System Data
+
+Timeseries Datapackage
+
+serve.py : read-only HTTP/JSON query service over the exported data
+
+"""
+
+import argparse
+from collections import OrderedDict
+from http.server import BaseHTTPRequestHandler, HTTPServer
+import json
+import logging
+import os
+from socketserver import ThreadingMixIn
+import threading
+import time
+from urllib.parse import parse_qs, urlencode, urlparse
+from urllib.request import urlopen
+
+import numpy as np
+import pandas as pd
+
+from .export import DATE_FORMAT, FLOAT_FORMAT, columnar_version, output_path
+
+logger = logging.getLogger('log')
+logger.setLevel('INFO')
+
+# Formats the query results can be returned in, with their content types.
+CONTENT_TYPES = {
+    'json': 'application/json',
+    'csv': 'text/csv',
+}
+
+# Default size limit of the cache of query results, in bytes.
+CACHE_BYTES = 256 * 1024**2
+
+
+class SliceCache(object):
+    """
+    Least-recently-used cache of encoded query results, evicting the oldest
+    entries once their total size exceeds ``max_bytes``. Safe to share
+    between threads.
+
+    Parameters
+    ----------
+    max_bytes : int
+        Total size of the cached results.
+
+    """
+
+    def __init__(self, max_bytes=CACHE_BYTES):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """Return the cached result for key, or None."""
+        with self._lock:
+            body = self._entries.get(key)
+            if body is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return body
+
+    def put(self, key, body):
+        """Cache body under key, unless it is larger than the whole cache."""
+        if len(body) > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._entries:
+                self.size -= len(self._entries.pop(key))
+            self._entries[key] = body
+            self.size += len(body)
+            while self.size > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self.size -= len(evicted)
+                self.evictions += 1
+
+    def stats(self):
+        """Return a dict of the number of entries, bytes, hits and misses."""
+        with self._lock:
+            return {
+                'entries': len(self._entries),
+                'bytes': self.size,
+                'max_bytes': self.max_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+            }
+
+
+class Store(object):
+    """
+    Memory-mapped access to the columnar outputs written by ``export`` with
+    the ``npy`` format. Only the rows and columns of a query are read from
+    disk. A resolution is reopened when it has been exported again.
+
+    Parameters
+    ----------
+    out_path : str
+        Directory the outputs were exported to.
+
+    """
+
+    def __init__(self, out_path):
+        self.out_path = out_path
+        self._frames = {}
+        self._lock = threading.Lock()
+
+    def _path(self, res_key):
+        return output_path(self.out_path, res_key, 'columnar', 'npy')
+
+    def resolutions(self):
+        """Return the sorted list of resolutions that can be queried."""
+        prefix, suffix = 'timeseries', '_columnar'
+        return sorted(
+            name[len(prefix):-len(suffix)] for name in os.listdir(self.out_path)
+            if name.startswith(prefix) and name.endswith(suffix)
+        )
+
+    def frame(self, res_key):
+        """
+        Open the data of one resolution. Returns a tuple of the version (the
+        name of its current arrays, see ``write_columnar``), the timestamps
+        as int64 nanoseconds, the memory-mapped values and a dict of column
+        positions by ``variable_region_attribute`` name.
+
+        """
+        path = self._path(res_key)
+        try:
+            version = columnar_version(path)
+        except OSError:
+            raise KeyError('unknown resolution: {}'.format(res_key))
+        with self._lock:
+            cached = self._frames.get(res_key)
+            if cached is not None and cached[0] == version:
+                return cached
+            # A version is never rewritten once CURRENT names it, so the
+            # mapping stays valid while a newer one is exported.
+            version_path = os.path.join(path, version)
+            with open(os.path.join(version_path, 'columns.json'), 'r') as f:
+                tuples = json.load(f)['tuples']
+            positions = {'_'.join(col[0:3]): pos
+                         for pos, col in enumerate(tuples)}
+            cached = (version,
+                      np.load(os.path.join(version_path, 'index.npy')),
+                      np.load(os.path.join(version_path, 'values.npy'),
+                              mmap_mode='r'),
+                      positions)
+            self._frames[res_key] = cached
+            return cached
+
+    def query(self, res_key, columns=None, start=None, end=None):
+        """
+        Select a slice of the data of one resolution. Returns a
+        pandas.DataFrame with ``variable_region_attribute`` column names.
+
+        Parameters
+        ----------
+        res_key : str
+            Resolution, e.g. ``15min``.
+        columns : list, optional
+            Names of the columns to return. Defaults to all.
+        start, end : datetime-like, optional
+            First and last timestamp (UTC) to return, both included.
+
+        """
+        version, index, values, positions = self.frame(res_key)
+        if columns is None:
+            columns = sorted(positions, key=positions.get)
+        unknown = [col for col in columns if col not in positions]
+        if unknown:
+            raise KeyError('unknown columns: {}'.format(', '.join(unknown)))
+
+        first = 0 if start is None else np.searchsorted(
+            index, pd.Timestamp(start).value, side='left')
+        last = len(index) if end is None else np.searchsorted(
+            index, pd.Timestamp(end).value, side='right')
+
+        # Each column is contiguous on disk, so copy them one by one.
+        data = np.empty((max(last - first, 0), len(columns)))
+        for i, col in enumerate(columns):
+            data[:, i] = values[first:last, positions[col]]
+        return pd.DataFrame(
+            data, columns=columns,
+            index=pd.DatetimeIndex(index[first:last].astype('datetime64[ns]'),
+                                   name='timestamp'))
+
+
+def encode(df, fmt):
+    """Encode a query result as ``json`` or ``csv``. Returns bytes."""
+    if fmt == 'csv':
+        return df.to_csv(float_format=FLOAT_FORMAT,
+                         date_format=DATE_FORMAT).encode('utf-8')
+    if fmt == 'json':
+        values = df.values.astype(object)
+        values[np.isnan(df.values)] = None
+        return json.dumps({
+            'columns': list(df.columns),
+            'index': list(df.index.strftime(DATE_FORMAT)),
+            'data': values.tolist(),
+        }).encode('utf-8')
+    raise ValueError('unknown format: {}'.format(fmt))
+
+
+class QueryHandler(BaseHTTPRequestHandler):
+    """
+    Answers GET requests to
+
+    ``/query?resolution=15min&columns=a,b&start=...&end=...&format=json``
+        a slice of the data, see Store.query,
+    ``/columns?resolution=15min``
+        the column names of a resolution,
+    ``/stats``
+        the cache statistics.
+
+    """
+
+    def _send(self, status, body, content_type='application/json'):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _error(self, status, message):
+        self._send(status, json.dumps({'error': message}).encode('utf-8'))
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        params = {k: v[-1] for k, v in parse_qs(url.query).items()}
+        store, cache = self.server.store, self.server.cache
+        try:
+            if url.path == '/stats':
+                body = json.dumps(cache.stats()).encode('utf-8')
+                return self._send(200, body)
+
+            if url.path == '/columns':
+                positions = store.frame(params.get('resolution', '60min'))[3]
+                body = json.dumps(sorted(positions, key=positions.get))
+                return self._send(200, body.encode('utf-8'))
+
+            if url.path != '/query':
+                return self._error(404, 'unknown path: {}'.format(url.path))
+
+            res_key = params.get('resolution', '60min')
+            fmt = params.get('format', 'json')
+            if fmt not in CONTENT_TYPES:
+                return self._error(400, 'unknown format: {}'.format(fmt))
+            columns = params.get('columns')
+            columns = columns.split(',') if columns else None
+            start, end = params.get('start'), params.get('end')
+
+            # A new export changes the version, so stale slices are missed.
+            key = (res_key, store.frame(res_key)[0],
+                   tuple(columns) if columns else None, start, end, fmt)
+            body = cache.get(key)
+            if body is None:
+                body = encode(store.query(res_key, columns, start, end), fmt)
+                cache.put(key, body)
+            self._send(200, body, CONTENT_TYPES[fmt])
+        except KeyError as e:
+            self._error(404, str(e.args[0]))
+        except ValueError as e:
+            self._error(400, str(e))
+
+    def log_message(self, format, *args):
+        logger.debug('%s - %s', self.address_string(), format % args)
+
+
+class QueryServer(ThreadingMixIn, HTTPServer):
+    """HTTP server answering each client in its own thread."""
+
+    daemon_threads = True
+
+    def __init__(self, address, store, cache):
+        HTTPServer.__init__(self, address, QueryHandler)
+        self.store = store
+        self.cache = cache
+
+
+def make_server(out_path, host='127.0.0.1', port=8000,
+                cache_bytes=CACHE_BYTES):
+    """
+    Set up the query service for the outputs in out_path without starting
+    it. Returns a QueryServer; call ``serve_forever`` to start it.
+
+    Parameters
+    ----------
+    out_path : str
+        Directory the data was exported to with the ``npy`` format.
+    host : str
+        Address to listen on. Defaults to local clients only.
+    port : int
+        Port to listen on, 0 for any free port.
+    cache_bytes : int
+        Size limit of the cache of query results.
+
+    """
+    store = Store(out_path)
+    logger.info('serving resolutions %s from %s on %s:%s',
+                store.resolutions(), out_path, host, port)
+    return QueryServer((host, port), store, SliceCache(cache_bytes))
+
+
+def benchmark(url, queries, clients=8, repeat=10):
+    """
+    Send queries to a running service from several clients at once and
+    measure latency and throughput. Returns a dict with the number of
+    requests, total seconds, requests per second and latency percentiles
+    in milliseconds.
+
+    Parameters
+    ----------
+    url : str
+        Base URL of the service, e.g. ``http://127.0.0.1:8000``.
+    queries : list
+        Dicts of query parameters, e.g. ``{'resolution': '60min',
+        'columns': 'load_DE_load', 'start': '2015-01-01'}``.
+    clients : int
+        Number of concurrent client threads.
+    repeat : int
+        Number of times each client sends all queries.
+
+    """
+    latencies = []
+    lock = threading.Lock()
+
+    def client():
+        own = []
+        for _ in range(repeat):
+            for params in queries:
+                started = time.time()
+                with urlopen('{}/query?{}'.format(url, urlencode(params))) as r:
+                    r.read()
+                own.append(time.time() - started)
+        with lock:
+            latencies.extend(own)
+
+    started = time.time()
+    threads = [threading.Thread(target=client) for _ in range(clients)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    seconds = time.time() - started
+
+    ms = np.array(latencies) * 1000
+    return {
+        'requests': len(latencies),
+        'seconds': seconds,
+        'requests_per_second': len(latencies) / seconds,
+        'p50_ms': float(np.percentile(ms, 50)),
+        'p95_ms': float(np.percentile(ms, 95)),
+        'p99_ms': float(np.percentile(ms, 99)),
+    }
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('out_path', type=str)
+    parser.add_argument('--host', type=str, default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--cache-mb', type=int, default=CACHE_BYTES // 1024**2)
+    args = parser.parse_args()
+
+    make_server(args.out_path, args.host, args.port,
+                args.cache_mb * 1024**2).serve_forever()
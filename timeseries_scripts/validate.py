@@ -0,0 +1,231 @@
+"""
+Open Power System Data
+
+Timeseries Datapackage
+
+validate.py : flag implausible values in all columns at once
+
+"""
+
+import logging
+
+import numpy as np
+import pandas as pd
+
+from .profiling import profiled
+
+try:
+    import bottleneck as bn
+except ImportError:
+    bn = None
+
+logger = logging.getLogger('log')
+logger.setLevel('INFO')
+
+# Flags, combined bitwise in the flag matrix.
+SPIKE = 1
+FROZEN = 2
+OVER_CAPACITY = 4
+NEGATIVE = 8
+
+FLAGS = {
+    'spike': SPIKE,
+    'frozen': FROZEN,
+    'over_capacity': OVER_CAPACITY,
+    'negative': NEGATIVE,
+}
+
+# Attributes of columns that measure generation and can neither be negative
+# nor exceed the installed capacity.
+GENERATION_ATTRIBUTES = ['generation', 'forecast']
+
+# Attributes of columns that are constant over long periods by nature and
+# are not checked for spikes or frozen values.
+STEP_ATTRIBUTES = ['capacity']
+
+# Rolling standard deviations up to this fraction of the mean are rounding
+# errors of a constant window.
+ZERO_STD = 1e-9
+
+
+def rows_per_day(index):
+    """Return the number of index entries per day, from the median step."""
+    if len(index) < 2:
+        return 1
+    step = np.median(np.diff(index.values.astype('datetime64[ns]')
+                             .astype(np.int64)))
+    return max(int(round(24 * 3600 * 10**9 / step)), 1)
+
+
+def _move_mean_std(values, window, min_count):
+    if bn is not None:
+        mean = bn.move_mean(values, window, min_count=min_count, axis=0)
+        std = bn.move_std(values, window, min_count=min_count, axis=0)
+        return mean, std
+    rolling = pd.DataFrame(values).rolling(window, min_periods=min_count)
+    return rolling.mean().values, rolling.std(ddof=0).values
+
+
+def rolling_zscore(values, window, min_count=None):
+    """
+    Compute the z-score of each value against the mean and standard
+    deviation of the window rows before it, for all columns of a 2d array at
+    once. Returns a float numpy.ndarray of the same shape, NaN where the
+    window holds fewer than min_count values.
+
+    """
+    if min_count is None:
+        min_count = window // 2 or 1
+    mean, std = _move_mean_std(values, window, min_count)
+    # Compare each value to the window ending one row earlier, so a spike
+    # does not dampen its own score.
+    mean = np.vstack([np.full((1, values.shape[1]), np.nan), mean[:-1]])
+    std = np.vstack([np.full((1, values.shape[1]), np.nan), std[:-1]])
+    with np.errstate(invalid='ignore', divide='ignore'):
+        z = (values - mean) / std
+        z[std <= ZERO_STD * np.abs(mean)] = np.nan
+    return z
+
+
+def _run_position(values):
+    """Return the number of identical values before each one in its run."""
+    same = np.zeros(values.shape, dtype=bool)
+    same[1:] = values[1:] == values[:-1]
+    rows = np.arange(values.shape[0])[:, None]
+    starts = np.maximum.accumulate(np.where(same, 0, rows), axis=0)
+    return rows - starts
+
+
+def run_lengths(values):
+    """
+    Compute the length of the run of identical consecutive values each value
+    belongs to, for all columns of a 2d array at once. Missing values are
+    never part of a run. Returns an int numpy.ndarray of the same shape.
+
+    """
+    if values.shape[0] == 0:
+        return np.zeros(values.shape, dtype=np.int64)
+    return _run_position(values) + _run_position(values[::-1])[::-1] + 1
+
+
+def capacity_columns(df, capacity=None):
+    """
+    Pair each generation column of df with the capacity column of the same
+    variable and region, looked up in capacity or else in df itself.
+    Returns a dict of generation column positions to capacity columns.
+
+    """
+    if capacity is None:
+        capacity = df
+
+    def key(columns):
+        return zip(columns.get_level_values('variable'),
+                   columns.get_level_values('region'),
+                   columns.get_level_values('attribute'))
+
+    available = {
+        (variable, region): col
+        for (variable, region, attribute), col
+        in zip(key(capacity.columns), capacity.columns)
+        if attribute == 'capacity'
+    }
+    pairs = {}
+    for pos, (variable, region, attribute) in enumerate(key(df.columns)):
+        if attribute in GENERATION_ATTRIBUTES \
+                and (variable, region) in available:
+            pairs[pos] = available[variable, region]
+    return pairs
+
+
+@profiled('validate')
+def validate(df, capacity=None, window=None, z_max=8, max_run=None,
+             max_ratio=1.05, since=None):
+    """
+    Check all columns of df for spikes, frozen values, generation above
+    installed capacity and negative generation. Returns a tuple of the flag
+    matrix, a pandas.DataFrame of uint8 with the same index and columns as
+    df in which the flags of each value are combined bitwise, and a summary
+    with the number of values flagged per column and check.
+
+    Parameters
+    ----------
+    df : pandas.DataFrame
+        One of the data sets, with columns labelled by ``headers``.
+    capacity : pandas.DataFrame, optional
+        Capacity timeseries as returned by ``read_capacities``. If None, the
+        capacity columns in df are used.
+    window : int, optional
+        Number of rows to compute the rolling z-score over. Defaults to one
+        day.
+    z_max : float
+        Values further than z_max standard deviations from the mean of the
+        window before them are flagged as spikes.
+    max_run : int, optional
+        Runs of more than max_run identical non-zero values are flagged as
+        frozen, except in capacity columns. Defaults to six hours.
+    max_ratio : float
+        Generation above max_ratio times the capacity is flagged.
+    since : datetime-like, optional
+        Only flag values from this timestamp on, e.g. those added by an
+        incremental update. Earlier rows are only read to fill the window.
+
+    """
+    per_day = rows_per_day(df.index)
+    if window is None:
+        window = per_day
+    if max_run is None:
+        max_run = max(per_day // 4, 2)
+
+    first = 0
+    if since is not None:
+        first = df.index.searchsorted(pd.Timestamp(since))
+        start = max(first - max(window, max_run), 0)
+        df = df.iloc[start:]
+        first -= start
+
+    values = np.asarray(df.values, dtype=np.float64)
+    flags = np.zeros(values.shape, dtype=np.uint8)
+
+    with np.errstate(invalid='ignore'):
+        attributes = df.columns.get_level_values('attribute')
+        steps = np.asarray(attributes.isin(STEP_ATTRIBUTES))
+        spikes = np.zeros(values.shape, dtype=bool)
+        spikes[:, ~steps] = np.abs(
+            rolling_zscore(values[:, ~steps], window)) > z_max
+        flags[spikes] |= SPIKE
+        frozen = (run_lengths(values) > max_run) & (values != 0) & ~steps
+        flags[frozen] |= FROZEN
+
+        generation = np.asarray(attributes.isin(GENERATION_ATTRIBUTES))
+        negative = (values < 0) & generation
+        flags[negative] |= NEGATIVE
+
+        pairs = capacity_columns(df, capacity)
+        if pairs:
+            positions = sorted(pairs)
+            source = df if capacity is None else capacity
+            cap = source[[pairs[pos] for pos in positions]]
+            cap = cap.reindex(df.index).values
+            over = values[:, positions] > max_ratio * cap
+            flags[:, positions] |= np.where(over, OVER_CAPACITY, 0) \
+                .astype(np.uint8)
+
+    flags = pd.DataFrame(flags[first:], index=df.index[first:],
+                         columns=df.columns)
+    summary = pd.DataFrame(
+        {name: (flags.values & bit).astype(bool).sum(axis=0)
+         for name, bit in FLAGS.items()},
+        index=df.columns, columns=list(FLAGS)
+    )
+    logger.info('validated %s values: %s flagged', flags.size,
+                int((flags.values != 0).sum()))
+    return flags, summary
+
+
+def flagged(flags, check):
+    """
+    Select the values flagged by one check, e.g. ``frozen``. Returns a
+    boolean pandas.DataFrame.
+
+    """
+    return (flags & FLAGS[check]).astype(bool)